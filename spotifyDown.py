@@ -7,10 +7,23 @@ and stunning animations. Now with YouTube anti-bot detection!
 
 Requirements:
     pip install flask spotipy yt-dlp
+    pip install boto3  (optional, for s3:// output directories)
+    pip install mutagen  (optional, ID3 tags and cover art)
 
 Usage:
     python spotify_premium_downloader.py
     Then open http://localhost:5000 in your browser
+
+Multi-process deployment (state and job queue in a shared SQLite file):
+    export SPOTIDOWN_STATE=/srv/spotidown/state.db SPOTIDOWN_SECRET_KEY=...
+    gunicorn -w 4 spotifyDown:app
+    python spotifyDown.py --runner
+
+Playlist mirroring (re-sync only playlists whose snapshot changed):
+    python spotifyDown.py --watch watch.json
+
+Load test of the UI endpoints against a synthetic job:
+    python spotifyDown.py --loadtest 50
 """
 
 import os
@@ -19,32 +32,223 @@ import threading
 import json
 import time
 import random
+import shutil
+import hashlib
+import uuid
+import socket
+import sqlite3
+import argparse
+import tempfile
+import gzip
+import glob
+import queue
+import copy
+import subprocess
+import multiprocessing
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from itertools import islice
+from array import array
+from collections import OrderedDict, deque
+from contextlib import closing
 from pathlib import Path
 from datetime import datetime
 
 from flask import Flask, render_template_string, request, jsonify, session
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import MemoryCacheHandler
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yt_dlp
+from yt_dlp.utils import DownloadCancelled
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+
+try:
+    from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TALB, TRCK, TPOS, TSRC, TXXX, APIC
+except ImportError:
+    ID3 = None
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# Must be stable and shared when several WSGI workers serve the same sessions
+app.secret_key = os.environ.get("SPOTIDOWN_SECRET_KEY") or os.urandom(24)
 
 # Global state
 download_status = {
+    "job_id": "",
     "running": False,
     "current_track": "",
     "current_artist": "",
     "progress": 0,
     "total": 0,
-    "completed": [],
-    "failed": [],
+    "completed_count": 0,
+    "failed_count": 0,
+    "retry_pending": 0,
     "log": [],
     "playlist_name": "",
     "playlist_image": "",
     "eta": ""
 }
 
+# Content-addressed library store shared by every playlist output_dir.
+# Layout: <LIBRARY_DIR>/objects/<sha[:2]>/<sha>.<ext> plus library.db, which maps
+# recording keys ("isrc:..." / "spotify:...") to content hashes and tracks the
+# playlist files that link to each object.
+LIBRARY_DIR = Path(os.environ.get("SPOTIDOWN_LIBRARY", "library"))
+library_ready = False
+library_lock = threading.Lock()
+
+# Global bandwidth cap (bytes/sec, 0 = unlimited) shared by every media download.
+# Each active download holds a slot; the cap is split across jobs by weight and
+# then evenly across that job's slots.
+bandwidth = {
+    "limit": int(os.environ.get("SPOTIDOWN_BANDWIDTH", "0")),
+    "weights": {},
+    "slots": [],
+}
+bandwidth_lock = threading.Lock()
+
+# Distributed mode: when a broker database is configured, the web node only lists
+# tracks and enqueues them; `python spotifyDown.py --worker` processes pull work.
+BROKER_DB = os.environ.get("SPOTIDOWN_BROKER", "")
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 3
+
+# Deferred retry pass for transient failures (timeouts, 429s, bot checks)
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 30.0
+
+# Output MP3 bitrate (kbps). Source streams are picked as the smallest audio-only
+# format that still meets it, after weighting codecs that beat MP3 per bit.
+TARGET_BITRATE = int(os.environ.get("SPOTIDOWN_BITRATE", "192"))
+CODEC_EFFICIENCY = {"opus": 1.5, "mp4a": 1.3, "aac": 1.3, "vorbis": 1.2}
+
+# Download engine tuning ("auto" tries aria2c, then parallel fragments, then native)
+FRAGMENT_CONCURRENCY = 4
+ARIA2C_CONNECTIONS = 8
+
+# Parallel downloads: the controller moves between 1 and MAX_CONCURRENCY
+INITIAL_CONCURRENCY = 2
+MAX_CONCURRENCY = int(os.environ.get("SPOTIDOWN_MAX_CONCURRENCY", "6"))
+
+# Object storage output: output_dir "s3://bucket/prefix" stages files locally
+# and uploads them with concurrent multipart transfers. SPOTIDOWN_S3_ENDPOINT
+# points at any S3-compatible service (e.g. MinIO).
+S3_ENDPOINT = os.environ.get("SPOTIDOWN_S3_ENDPOINT") or None
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 8
+storage_backends = {}
+storage_lock = threading.Lock()
+
+# Scratch space: with SPOTIDOWN_SCRATCH set (e.g. /dev/shm/spotidown), .part
+# files, intermediate containers and the transcode live there, and only the
+# finished MP3 is moved into output_dir. Per-track dirs are "<pid>.<random>".
+SCRATCH_DIR = os.environ.get("SPOTIDOWN_SCRATCH", "")
+SCRATCH_MIN_FREE = 512 * 1024 * 1024
+
+# Tagging: finished files get ID3 tags and cover art in a small finalisation
+# pool, off the download threads. Artwork is fetched once per album into a
+# size-bounded LRU directory shared by every job and process.
+TAGGING = os.environ.get("SPOTIDOWN_TAGS", "1") == "1"
+ARTWORK_DIR = Path(os.environ.get("SPOTIDOWN_ARTWORK", "artwork"))
+ARTWORK_CACHE_BYTES = 256 * 1024 * 1024
+finalize_pool = None
+finalize_pending = 0
+finalize_cond = threading.Condition()
+
+# Optional audio fingerprinting (Chromaprint's fpcalc): near-identical audio
+# stored under different recordings is collapsed into links to one object.
+# Only without tagging, since a shared object can't carry each track's tags.
+FINGERPRINTS = os.environ.get("SPOTIDOWN_FINGERPRINT", "0") == "1"
+FINGERPRINT_MATCH = 0.85       # fraction of matching fingerprint bits
+FINGERPRINT_MAX_OFFSET = 5     # alignment search, in fingerprint frames
+FINGERPRINT_DURATION_SLACK = 3.0
+fingerprint_ready = False
+fingerprint_lock = threading.Lock()
+fingerprint_pool = None
+
+# Resolve-only jobs write their YouTube matches to a manifest in output_dir;
+# later download runs use matches above MIN_MANIFEST_CONFIDENCE directly.
+MANIFEST_NAME = ".spotidown_manifest.json"
+RESOLVE_CONCURRENCY = 16
+MIN_MANIFEST_CONFIDENCE = 0.5
+ERROR_BACKOFF_RATE = 0.2
+
+# Existing files are probed before a job skips them; results are cached in a
+# sidecar keyed by (name, size, mtime) so unchanged files are probed once.
+VERIFY_INDEX_NAME = ".spotidown_verified.json"
+VERIFY_CONCURRENCY = os.cpu_count() or 4
+MIN_DURATION_RATIO = 0.75
+status_lock = threading.RLock()
+inflight = {}
+inflight_lock = threading.Lock()
+
+# Watchdog: per-track wall-clock budget and minimum throughput (bytes/sec,
+# measured over THROUGHPUT_WINDOW seconds). Hedged attempts are opt-in.
+# Progress hooks only fire while data arrives, so reads time out after
+# WATCHDOG_SOCKET_TIMEOUT and run_hedged abandons attempts past the budget.
+TRACK_TIME_BUDGET = float(os.environ.get("SPOTIDOWN_TRACK_BUDGET", "300"))
+MIN_THROUGHPUT = 32 * 1024
+THROUGHPUT_WINDOW = 20.0
+WATCHDOG_SOCKET_TIMEOUT = 15
+HEDGE_DOWNLOADS = os.environ.get("SPOTIDOWN_HEDGE", "0") == "1"
+watchdog_watches = []
+watchdog_thread = None
+watchdog_lock = threading.Lock()
+download_latencies = deque(maxlen=200)
+
+# YouTube player clients. With RACE_CLIENTS each search is extracted with every
+# client at once and the first valid result is used. Once one client clearly
+# dominates, only it is raced except for every RACE_EXPLORE_EVERY-th track.
+PLAYER_CLIENTS = ["android", "web"]
+RACE_CLIENTS = os.environ.get("SPOTIDOWN_RACE_CLIENTS", "0") == "1"
+RACE_EXPLORE_EVERY = 10
+client_stats = {}
+client_stats_lock = threading.Lock()
+race_counter = 0
+
+# Job logs: JSON-lines files under LOG_DIR/<job_id>/, rotated every
+# LOG_SEGMENT_LINES entries into gzip segments. Only a short tail is kept in
+# memory, for the most recent MAX_OPEN_LOGS jobs.
+LOG_DIR = Path(os.environ.get("SPOTIDOWN_LOGS", "logs"))
+LOG_SEGMENT_LINES = 1000
+LOG_TAIL = 500
+MAX_OPEN_LOGS = 16
+job_logs = OrderedDict()
+job_logs_lock = threading.Lock()
+
+# Per-track results for the same recent jobs, served by /jobs/<id>/results
+job_results = OrderedDict()
+job_results_lock = threading.Lock()
+
+# Externalised state: with a state database, /start only queues the job and a
+# separate `--runner` process executes it and publishes its status, so any
+# number of WSGI workers can serve the UI.
+STATE_DB = os.environ.get("SPOTIDOWN_STATE", "")
+STATE_PUBLISH_INTERVAL = 0.5
+state_store_instance = None
+
+# Playlist watcher: polls only snapshot_id for each watched playlist and syncs
+# the ones that changed. Intervals get +/- WATCH_JITTER so polls spread out.
+WATCH_INTERVAL = 3600
+WATCH_JITTER = 0.1
+WATCH_CONCURRENCY = 8
+
+# Job history and per-track index, written as jobs run and served by
+# /history and /tracks. Set SPOTIDOWN_HISTORY to "" to disable it.
+HISTORY_DB = os.environ.get("SPOTIDOWN_HISTORY", "history.db")
+history_store_instance = None
+
+# Spotify clients keyed by client ID, shared by every job in this process
+spotify_clients = {}
+spotify_clients_lock = threading.Lock()
+
 # ============== PREMIUM HTML TEMPLATE ==============
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -573,6 +777,14 @@ HTML_TEMPLATE = """
             color: var(--primary);
         }
 
+        .progress-meta {
+            display: flex;
+            justify-content: space-between;
+            margin-top: 10px;
+            font-size: 12px;
+            color: var(--text-muted);
+        }
+
         .progress-bar-track {
             height: 8px;
             background: rgba(255, 255, 255, 0.1);
@@ -665,8 +877,6 @@ HTML_TEMPLATE = """
             background: rgba(0, 0, 0, 0.3);
             border-radius: 14px;
             padding: 20px;
-            max-height: 250px;
-            overflow-y: auto;
         }
 
         .log-header {
@@ -683,18 +893,41 @@ HTML_TEMPLATE = """
             font-weight: 500;
         }
 
+        /* Virtualised: only the visible rows exist, positioned over a spacer */
         .log-entries {
             font-family: 'SF Mono', 'Fira Code', monospace;
             font-size: 12px;
+            position: relative;
+            height: 170px;
+            overflow-y: auto;
+        }
+
+        .log-spacer {
+            width: 1px;
         }
 
         .log-entry {
+            position: absolute;
+            top: 0;
+            left: 0;
+            right: 0;
+            height: 34px;
             display: flex;
-            align-items: flex-start;
+            align-items: center;
             gap: 10px;
-            padding: 8px 0;
             border-bottom: 1px solid rgba(255,255,255,0.03);
-            animation: slideIn 0.3s ease;
+        }
+
+        .log-load-older {
+            margin-left: auto;
+            background: none;
+            border: 1px solid var(--border);
+            border-radius: 8px;
+            color: var(--text-muted);
+            font-size: 12px;
+            padding: 4px 10px;
+            cursor: pointer;
+            display: none;
         }
 
         @keyframes slideIn {
@@ -732,6 +965,9 @@ HTML_TEMPLATE = """
             flex: 1;
             color: rgba(255, 255, 255, 0.7);
             line-height: 1.4;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
         }
 
         /* Results */
@@ -927,8 +1163,12 @@ HTML_TEMPLATE = """
                 </p>
 
                 <div class="form-group">
-                    <label class="form-label">Playlist URL</label>
-                    <input type="text" class="form-input" id="playlist_url" placeholder="https://open.spotify.com/playlist/...">
+                    <label class="form-label">Spotify URLs</label>
+                    <textarea class="form-input" id="playlist_url" rows="3" placeholder="https://open.spotify.com/playlist/... (one per line: playlists, albums, tracks or artists)"></textarea>
+                    <p class="form-hint">
+                        Paste several links, or <a href="#" onclick="document.getElementById('url_file').click(); return false;">upload a list</a>.
+                    </p>
+                    <input type="file" id="url_file" accept=".txt,.csv" style="display: none;" onchange="loadUrlFile(this)">
                 </div>
 
                 <div class="form-grid">
@@ -950,6 +1190,25 @@ HTML_TEMPLATE = """
                 </div>
                 <p class="form-hint">Cookies help bypass YouTube restrictions. Make sure the browser is closed.</p>
 
+                <div class="form-grid" style="margin-top: 24px;">
+                    <div class="form-group">
+                        <label class="form-label">Download Engine</label>
+                        <select class="form-select" id="engine_choice">
+                            <option value="auto">Auto (fastest available)</option>
+                            <option value="native">Native (single connection)</option>
+                            <option value="fragments">Native + parallel fragments</option>
+                            <option value="aria2c">aria2c (multi-connection)</option>
+                        </select>
+                    </div>
+                    <div class="form-group">
+                        <label class="form-label">Mode</label>
+                        <select class="form-select" id="mode_choice">
+                            <option value="download">Download</option>
+                            <option value="resolve">Resolve only (plan, no download)</option>
+                        </select>
+                    </div>
+                </div>
+
                 <button class="btn-primary" id="download-btn" onclick="startDownload()">
                     <span class="btn-icon">⬇️</span>
                     <span id="btn-text">Start Download</span>
@@ -998,6 +1257,10 @@ HTML_TEMPLATE = """
                     <div class="progress-bar-track">
                         <div class="progress-bar-fill" id="progress-bar"></div>
                     </div>
+                    <div class="progress-meta">
+                        <span id="eta-label"></span>
+                        <span id="bandwidth-label"></span>
+                    </div>
                 </div>
 
                 <!-- Log -->
@@ -1005,8 +1268,11 @@ HTML_TEMPLATE = """
                     <div class="log-header">
                         <span>📋</span>
                         <span>Activity Log</span>
+                        <button class="log-load-older" id="log-load-older" onclick="loadOlderLogs()">Load older</button>
+                    </div>
+                    <div class="log-entries" id="log-entries">
+                        <div class="log-spacer" id="log-spacer"></div>
                     </div>
-                    <div class="log-entries" id="log-entries"></div>
                 </div>
 
                 <!-- Results -->
@@ -1107,6 +1373,7 @@ HTML_TEMPLATE = """
         }
 
         let pollInterval = null;
+        let logCursor = 0;
 
         async function startDownload() {
             const clientId = document.getElementById('client_id').value.trim();
@@ -1114,6 +1381,8 @@ HTML_TEMPLATE = """
             const playlistUrl = document.getElementById('playlist_url').value.trim();
             const outputDir = document.getElementById('output_dir').value.trim();
             const browserChoice = document.getElementById('browser_choice').value;
+            const engineChoice = document.getElementById('engine_choice').value;
+            const modeChoice = document.getElementById('mode_choice').value;
 
             if (!clientId || !clientSecret || !playlistUrl) {
                 showToast('Please fill in all required fields', 'error');
@@ -1127,7 +1396,8 @@ HTML_TEMPLATE = """
             btnText.innerHTML = '<div class="spinner"></div> Starting...';
             
             document.getElementById('progress-section').classList.add('active');
-            document.getElementById('log-entries').innerHTML = '';
+            clearLogs();
+            logCursor = 0;
             document.getElementById('results-section').classList.remove('active');
             document.getElementById('playlist-info').style.display = 'none';
 
@@ -1143,7 +1413,9 @@ HTML_TEMPLATE = """
                         client_secret: clientSecret,
                         playlist_url: playlistUrl,
                         output_dir: outputDir,
-                        browser: browserChoice
+                        browser: browserChoice,
+                        engine: engineChoice,
+                        mode: modeChoice
                     })
                 });
 
@@ -1167,7 +1439,7 @@ HTML_TEMPLATE = """
 
         async function pollStatus() {
             try {
-                const response = await fetch('/status');
+                const response = await fetch(`/status?log_since=${logCursor}`);
                 const status = await response.json();
 
                 // Update progress
@@ -1195,21 +1467,28 @@ HTML_TEMPLATE = """
                     }
                 }
 
+                updateBandwidth(status.bandwidth);
+                document.getElementById('eta-label').textContent = status.eta
+                    ? `ETA ${status.eta} · ${status.concurrency || 1} parallel`
+                    : '';
+
                 // Add log entries
-                status.log.forEach(entry => addLog(entry.message, entry.type));
+                currentJobId = status.job_id || '';
+                status.log.forEach(entry => addLog(entry.message, entry.type, entry.seq));
+                logCursor = status.log_next;
 
                 // Check if finished
                 if (!status.running && status.progress > 0) {
                     clearInterval(pollInterval);
                     document.getElementById('results-section').classList.add('active');
                     document.getElementById('total-count').textContent = status.total;
-                    document.getElementById('success-count').textContent = status.completed.length;
-                    document.getElementById('failed-count').textContent = status.failed.length;
+                    document.getElementById('success-count').textContent = status.completed_count;
+                    document.getElementById('failed-count').textContent = status.failed_count;
                     
                     document.getElementById('current-track-name').textContent = 'Complete!';
                     document.getElementById('current-track-artist').textContent = '';
                     
-                    showToast(`Downloaded ${status.completed.length} of ${status.total} tracks!`, 'success');
+                    showToast(`Downloaded ${status.completed_count} of ${status.total} tracks!`, 'success');
                     resetButton();
                 }
 
@@ -1218,25 +1497,113 @@ HTML_TEMPLATE = """
             }
         }
 
-        function addLog(message, type = 'info') {
-            const container = document.getElementById('log-entries');
-            const icons = { success: '✓', error: '✗', info: 'ℹ' };
-            
-            const entry = document.createElement('div');
-            entry.className = `log-entry ${type}`;
-            const iconDiv = document.createElement('div');
-            iconDiv.className = 'log-icon';
-            iconDiv.textContent = icons[type];
-            entry.appendChild(iconDiv);
+        // Activity log: entries are buffered and flushed once per animation
+        // frame into a virtual list that only keeps the visible rows in the DOM.
+        const LOG_ROW_HEIGHT = 34;
+        const LOG_MAX_ITEMS = 50000;
+        const LOG_PAGE = 500;
+        const LOG_ICONS = { success: '✓', error: '✗', info: 'ℹ' };
+        let logItems = [];
+        let pendingLogs = [];
+        let logRows = [];
+        let logFlushScheduled = false;
+        let logRenderScheduled = false;
+        let currentJobId = '';
+
+        function addLog(message, type = 'info', seq = null) {
+            pendingLogs.push({ message, type, seq });
+            if (!logFlushScheduled) {
+                logFlushScheduled = true;
+                requestAnimationFrame(flushLogs);
+            }
+        }
+
+        function flushLogs() {
+            logFlushScheduled = false;
+            const viewport = document.getElementById('log-entries');
+            const atBottom = viewport.scrollTop + viewport.clientHeight >= viewport.scrollHeight - LOG_ROW_HEIGHT;
+
+            for (const item of pendingLogs) logItems.push(item);
+            pendingLogs = [];
+            if (logItems.length > LOG_MAX_ITEMS) {
+                logItems.splice(0, logItems.length - LOG_MAX_ITEMS);
+            }
+
+            document.getElementById('log-spacer').style.height = (logItems.length * LOG_ROW_HEIGHT) + 'px';
+            // One scroll write per frame instead of one forced layout per entry
+            if (atBottom) viewport.scrollTop = logItems.length * LOG_ROW_HEIGHT;
+            renderLogRows();
+        }
+
+        function renderLogRows() {
+            logRenderScheduled = false;
+            const viewport = document.getElementById('log-entries');
+            const first = Math.max(0, Math.floor(viewport.scrollTop / LOG_ROW_HEIGHT) - 2);
+            const count = Math.ceil(viewport.clientHeight / LOG_ROW_HEIGHT) + 6;
+
+            while (logRows.length < count) {
+                const entry = document.createElement('div');
+                const iconDiv = document.createElement('div');
+                iconDiv.className = 'log-icon';
+                const msgDiv = document.createElement('div');
+                msgDiv.className = 'log-message';
+                entry.appendChild(iconDiv);
+                entry.appendChild(msgDiv);
+                viewport.appendChild(entry);
+                logRows.push({ entry, iconDiv, msgDiv });
+            }
+
+            logRows.forEach((row, i) => {
+                const item = logItems[first + i];
+                if (!item) {
+                    row.entry.style.display = 'none';
+                    return;
+                }
+                row.entry.style.display = '';
+                row.entry.style.transform = `translateY(${(first + i) * LOG_ROW_HEIGHT}px)`;
+                row.entry.className = `log-entry ${item.type}`;
+                row.iconDiv.textContent = LOG_ICONS[item.type] || LOG_ICONS.info;
+                row.msgDiv.textContent = item.message;
+                row.msgDiv.title = item.message;
+            });
+
+            const oldest = logItems.length ? logItems[0].seq : null;
+            document.getElementById('log-load-older').style.display = oldest > 0 ? 'block' : 'none';
+        }
 
-            const msgDiv = document.createElement('div');
-            msgDiv.className = 'log-message';
-            msgDiv.textContent = message;
-            entry.appendChild(msgDiv);
-            container.appendChild(entry);
-            container.scrollTop = container.scrollHeight;
+        function clearLogs() {
+            logItems = [];
+            pendingLogs = [];
+            document.getElementById('log-spacer').style.height = '0px';
+            document.getElementById('log-entries').scrollTop = 0;
+            renderLogRows();
         }
 
+        async function loadOlderLogs() {
+            const oldest = logItems.length ? logItems[0].seq : null;
+            if (!currentJobId || !(oldest > 0)) return;
+            const offset = Math.max(0, oldest - LOG_PAGE);
+            try {
+                const response = await fetch(`/jobs/${currentJobId}/log?offset=${offset}&limit=${oldest - offset}`);
+                const data = await response.json();
+                const older = (data.entries || []).map(e => ({ message: e.message, type: e.type, seq: e.seq }));
+                const viewport = document.getElementById('log-entries');
+                logItems = older.concat(logItems);
+                document.getElementById('log-spacer').style.height = (logItems.length * LOG_ROW_HEIGHT) + 'px';
+                viewport.scrollTop += older.length * LOG_ROW_HEIGHT;
+                renderLogRows();
+            } catch (error) {
+                console.error('Log fetch error:', error);
+            }
+        }
+
+        document.getElementById('log-entries').addEventListener('scroll', () => {
+            if (!logRenderScheduled) {
+                logRenderScheduled = true;
+                requestAnimationFrame(renderLogRows);
+            }
+        });
+
         function resetButton() {
             const btn = document.getElementById('download-btn');
             const btnText = document.getElementById('btn-text');
@@ -1244,6 +1611,30 @@ HTML_TEMPLATE = """
             btnText.innerHTML = '<span class="btn-icon">⬇️</span> Start Download';
         }
 
+        function formatRate(bytesPerSec) {
+            if (bytesPerSec >= 1048576) return (bytesPerSec / 1048576).toFixed(1) + ' MB/s';
+            return Math.round(bytesPerSec / 1024) + ' KB/s';
+        }
+
+        function updateBandwidth(bw) {
+            if (!bw) return;
+            const limit = bw.limit > 0 ? ' of ' + formatRate(bw.limit) : '';
+            document.getElementById('bandwidth-label').textContent = '⇅ ' + formatRate(bw.used) + limit;
+        }
+
+        function loadUrlFile(input) {
+            const file = input.files[0];
+            if (!file) return;
+            const reader = new FileReader();
+            reader.onload = () => {
+                const field = document.getElementById('playlist_url');
+                field.value = (field.value.trim() + '\\n' + reader.result).trim();
+                showToast(`Loaded ${file.name}`, 'success');
+            };
+            reader.readAsText(file);
+            input.value = '';
+        }
+
         // Save credentials to localStorage
         document.getElementById('client_id').addEventListener('change', saveCredentials);
         document.getElementById('client_secret').addEventListener('change', saveCredentials);
@@ -1268,17 +1659,35 @@ HTML_TEMPLATE = """
 
 # ============== HELPER FUNCTIONS ==============
 
-def extract_playlist_id(playlist_url: str) -> str:
-    patterns = [
-        r"spotify\.com/playlist/([a-zA-Z0-9]+)",
-        r"spotify:playlist:([a-zA-Z0-9]+)",
-        r"^([a-zA-Z0-9]{22})$",
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, playlist_url)
+SPOTIFY_URL_PATTERNS = [
+    r"spotify\.com/(?:intl-[a-z-]+/)?(playlist|album|track|artist)/([a-zA-Z0-9]+)",
+    r"spotify:(playlist|album|track|artist):([a-zA-Z0-9]+)",
+]
+
+
+def parse_spotify_url(url: str):
+    """Return (kind, id) for a playlist, album, track or artist URL/URI.
+
+    A bare 22-character ID is treated as a playlist.
+    """
+    for pattern in SPOTIFY_URL_PATTERNS:
+        match = re.search(pattern, url)
         if match:
-            return match.group(1)
-    raise ValueError(f"Invalid playlist URL: {playlist_url}")
+            return match.group(1), match.group(2)
+    match = re.search(r"^([a-zA-Z0-9]{22})$", url)
+    if match:
+        return "playlist", match.group(1)
+    raise ValueError(f"Invalid Spotify URL: {url}")
+
+
+def split_urls(text: str) -> list:
+    """Split pasted or uploaded text into individual URLs, ignoring blanks and comments."""
+    urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            urls.extend(part for part in re.split(r"[\s,]+", line) if part)
+    return urls
 
 
 def sanitize_filename(name: str) -> str:
@@ -1288,8 +1697,316 @@ def sanitize_filename(name: str) -> str:
     return name.strip()
 
 
+def recording_keys(track_info: dict) -> list:
+    """Return the dedup keys (ISRC first, then Spotify ID) for a track."""
+    keys = []
+    if track_info.get("isrc"):
+        keys.append(f"isrc:{track_info['isrc'].upper()}")
+    if track_info.get("id"):
+        keys.append(f"spotify:{track_info['id']}")
+    return keys
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    """Clone src into dst with a copy-on-write reflink (Linux FICLONE)."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        dst.unlink(missing_ok=True)
+        return False
+
+
+def link_file(src: Path, dst: Path, hardlink: bool = True) -> str:
+    """Place src at dst as a hardlink, reflink or (last resort) a copy.
+
+    No symlinks: playlist dirs are often read from other hosts (NAS media
+    servers) where a link into the library would dangle. hardlink=False is
+    for files that will be modified (retagged) independently of src.
+    """
+    if dst.exists():
+        return "exists"
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    if _reflink(src, dst):
+        return "reflink"
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ============== LIBRARY STORE ==============
+
+def _library_connect():
+    """Connection to the library index (SQLite, WAL), creating it on first use.
+
+    Every change runs in one BEGIN IMMEDIATE transaction, so servers, job
+    runners and workers sharing LIBRARY_DIR see each other's ingests.
+    An index.json from older versions is imported once.
+    """
+    global library_ready
+    with library_lock:
+        if not library_ready:
+            LIBRARY_DIR.mkdir(parents=True, exist_ok=True)
+            with closing(sqlite3.connect(str(LIBRARY_DIR / "library.db"), timeout=30, isolation_level=None)) as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, ext TEXT NOT NULL)")
+                db.execute("CREATE TABLE IF NOT EXISTS recordings (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS refs (
+                        digest TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        PRIMARY KEY (digest, path)
+                    )
+                """)
+                db.execute("CREATE INDEX IF NOT EXISTS idx_recordings_digest ON recordings (digest)")
+                index_file = LIBRARY_DIR / "index.json"
+                if index_file.exists():
+                    index = json.loads(index_file.read_text(encoding="utf-8"))
+                    db.execute("BEGIN IMMEDIATE")
+                    for digest, obj in index.get("objects", {}).items():
+                        db.execute("INSERT OR IGNORE INTO objects (digest, ext) VALUES (?, ?)", (digest, obj["ext"]))
+                        db.executemany(
+                            "INSERT OR IGNORE INTO refs (digest, path) VALUES (?, ?)",
+                            [(digest, ref) for ref in obj.get("refs", [])]
+                        )
+                    db.executemany(
+                        "INSERT OR IGNORE INTO recordings (key, digest) VALUES (?, ?)",
+                        list(index.get("recordings", {}).items())
+                    )
+                    db.execute("COMMIT")
+                    os.replace(index_file, index_file.with_suffix(".json.migrated"))
+            library_ready = True
+    return sqlite3.connect(str(LIBRARY_DIR / "library.db"), timeout=30, isolation_level=None)
+
+
+def _object_path(digest: str, ext: str) -> Path:
+    return LIBRARY_DIR / "objects" / digest[:2] / f"{digest}{ext}"
+
+
+def _library_add_ref(db, digest: str, path: Path):
+    db.execute("INSERT OR IGNORE INTO refs (digest, path) VALUES (?, ?)", (digest, str(path.absolute())))
+
+
+def library_lookup(keys: list):
+    """Return the stored object for any of the given recording keys, or None."""
+    with closing(_library_connect()) as db:
+        for key in keys:
+            row = db.execute(
+                "SELECT objects.digest, objects.ext FROM recordings "
+                "JOIN objects ON objects.digest = recordings.digest WHERE recordings.key = ?",
+                (key,)
+            ).fetchone()
+            if row:
+                path = _object_path(*row)
+                if path.exists():
+                    return path
+    return None
+
+
+def library_lookup_track(keys: list):
+    """Find a track in the library. Returns (stored object or None, can hardlink).
+
+    With tagging, only an object stored under the track's own Spotify key
+    already carries its tags; a hit through another key needs a private copy.
+    """
+    stored = library_lookup([key for key in keys if key.startswith("spotify:")])
+    if stored:
+        return stored, True
+    stored = library_lookup(keys)
+    return stored, stored is not None and not tagging_enabled()
+
+
+def library_ingest(path: Path, keys: list) -> Path:
+    """Move a finished file into the store and leave a link in its place.
+
+    When the store is on another filesystem the playlist keeps its real file
+    and the store gets a copy.
+    """
+    digest = hash_file(path)
+    with closing(_library_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("INSERT OR IGNORE INTO objects (digest, ext) VALUES (?, ?)", (digest, path.suffix))
+        ext = db.execute("SELECT ext FROM objects WHERE digest = ?", (digest,)).fetchone()[0]
+        stored = _object_path(digest, ext)
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        same_fs = path.stat().st_dev == stored.parent.stat().st_dev
+        if stored.exists():
+            if same_fs:
+                path.unlink()
+                link_file(stored, path)
+        elif same_fs:
+            shutil.move(str(path), str(stored))
+            link_file(stored, path)
+        else:
+            shutil.copy2(path, stored)
+        db.executemany(
+            "INSERT OR REPLACE INTO recordings (key, digest) VALUES (?, ?)",
+            [(key, digest) for key in keys]
+        )
+        _library_add_ref(db, digest, path)
+        db.execute("COMMIT")
+    return stored
+
+
+def library_link(stored: Path, dst: Path, private: bool = False) -> str:
+    """Materialise a stored object in a playlist directory and count the ref.
+
+    private gives dst its own data (reflink or copy) so it can be retagged.
+    """
+    method = link_file(stored, dst, hardlink=not private)
+    with closing(_library_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        if db.execute("SELECT 1 FROM objects WHERE digest = ?", (stored.stem,)).fetchone():
+            _library_add_ref(db, stored.stem, dst)
+        db.execute("COMMIT")
+    return method
+
+
+def library_gc() -> dict:
+    """Drop refs whose playlist file is gone, then delete unreferenced objects."""
+    removed = 0
+    freed = 0
+    with closing(_library_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        for digest, ext in db.execute("SELECT digest, ext FROM objects").fetchall():
+            stored = _object_path(digest, ext)
+            live = 0
+            for (ref,) in db.execute("SELECT path FROM refs WHERE digest = ?", (digest,)).fetchall():
+                try:
+                    if os.path.samefile(ref, stored) or hash_file(Path(ref)) == digest:
+                        live += 1
+                        continue
+                except OSError:
+                    pass
+                db.execute("DELETE FROM refs WHERE digest = ? AND path = ?", (digest, ref))
+            if live:
+                continue
+            if stored.exists():
+                freed += stored.stat().st_size
+                stored.unlink()
+            db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+            removed += 1
+        db.execute("DELETE FROM recordings WHERE digest NOT IN (SELECT digest FROM objects)")
+        db.execute("COMMIT")
+    return {"objects_removed": removed, "bytes_freed": freed}
+
+
+def library_discard(path: Path, keys: list):
+    """Forget recordings whose stored object is (or maps to) a corrupt file."""
+    with closing(_library_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        for key in keys:
+            row = db.execute(
+                "SELECT objects.digest, objects.ext FROM recordings "
+                "JOIN objects ON objects.digest = recordings.digest WHERE recordings.key = ?",
+                (key,)
+            ).fetchone()
+            db.execute("DELETE FROM recordings WHERE key = ?", (key,))
+            if row is None:
+                continue
+            stored = _object_path(*row)
+            try:
+                same = os.path.samefile(path, stored)
+            except OSError:
+                same = False
+            if same:
+                stored.unlink()
+                db.execute("DELETE FROM objects WHERE digest = ?", (row[0],))
+                db.execute("DELETE FROM refs WHERE digest = ?", (row[0],))
+        db.execute("COMMIT")
+
+
+def library_merge(path: Path, keys: list, duplicate: str, keep: str):
+    """Replace a playlist file with a link to the kept object and drop the duplicate object.
+
+    The file takes on the kept object's tags, so this only runs without
+    tagging. Returns the link method, or None when the kept object is gone.
+    """
+    with closing(_library_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT ext FROM objects WHERE digest = ?", (keep,)).fetchone()
+        if row is None or not _object_path(keep, row[0]).exists():
+            db.execute("ROLLBACK")
+            return None
+        path.unlink(missing_ok=True)
+        method = link_file(_object_path(keep, row[0]), path)
+        db.executemany(
+            "INSERT OR REPLACE INTO recordings (key, digest) VALUES (?, ?)",
+            [(key, keep) for key in keys]
+        )
+        _library_add_ref(db, keep, path)
+        db.execute("DELETE FROM refs WHERE digest = ? AND path = ?", (duplicate, str(path.absolute())))
+        dup = db.execute("SELECT ext FROM objects WHERE digest = ?", (duplicate,)).fetchone()
+        if dup is not None and not db.execute("SELECT 1 FROM refs WHERE digest = ?", (duplicate,)).fetchone():
+            _object_path(duplicate, dup[0]).unlink(missing_ok=True)
+            db.execute("DELETE FROM objects WHERE digest = ?", (duplicate,))
+        db.execute("COMMIT")
+    return method
+
+
 def add_log(message: str, log_type: str = "info"):
-    download_status["log"].append({"message": message, "type": log_type})
+    entry = {"message": message, "type": log_type}
+    log = job_logs.get(download_status.get("job_id"))
+    if log is not None:
+        log.append(entry)
+    else:
+        # Worker processes have no job log; entries are shipped with the result
+        download_status.setdefault("log", []).append(entry)
+
+
+# Substrings of yt-dlp errors, checked in order, and the class they map to
+ERROR_CLASSES = [
+    ("rate_limited", ("http error 429", "too many requests")),
+    ("stalled", ("stalled:",)),
+    ("bot_check", ("sign in to confirm", "not a bot", "confirm your age")),
+    ("timeout", ("timed out", "timeout", "connection reset", "temporarily unavailable")),
+    ("unavailable", ("video unavailable", "private video", "has been removed", "not available")),
+    ("no_results", ("no video results", "no results", "playlist does not exist")),
+    ("cookies", ("cookies", "cookie database")),
+    ("ffmpeg", ("ffmpeg", "ffprobe", "postprocessing")),
+]
+
+
+# Error classes that will not go away by retrying the same track
+PERMANENT_ERRORS = {"unavailable", "no_results", "ffmpeg"}
+
+
+# Error classes worth retrying later; cookie and unrecognised errors fail the track
+TRANSIENT_ERRORS = {"rate_limited", "stalled", "bot_check", "timeout"}
+
+# Errors raised by YouTube rather than the engine, which another engine won't avoid
+SOURCE_ERRORS = PERMANENT_ERRORS | {"rate_limited", "bot_check"}
+
+
+def is_transient(error_class: str) -> bool:
+    return error_class in TRANSIENT_ERRORS
+
+
+def classify_error(msg: str) -> str:
+    """Map a yt-dlp error message to a short error class."""
+    lowered = msg.lower()
+    for error_class, needles in ERROR_CLASSES:
+        if any(needle in lowered for needle in needles):
+            return error_class
+    return "other"
 
 
 def clean_error_message(msg: str) -> str:
@@ -1301,180 +2018,2771 @@ def clean_error_message(msg: str) -> str:
     return cleaned
 
 
-def download_worker(client_id: str, client_secret: str, playlist_url: str, output_dir: str, browser: str):
-    global download_status
+# ============== JOB LOGS ==============
+
+class JobLog:
+    """Persistent log for one job with a bounded in-memory tail.
+
+    Segment n holds entries n * LOG_SEGMENT_LINES onwards, so the segment for
+    any offset is found arithmetically and only that file is read.
+    """
+
+    def __init__(self, job_id: str):
+        self.dir = LOG_DIR / job_id
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.tail = deque(maxlen=LOG_TAIL)
+        self._file = None
+        closed = len(list(self.dir.glob("*.jsonl.gz")))
+        current = self._segment_path(closed)
+        open_lines = 0
+        if current.exists():
+            with open(current, "rb") as f:
+                open_lines = sum(1 for _ in f)
+        self.count = closed * LOG_SEGMENT_LINES + open_lines
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.dir / f"{segment:06d}.jsonl"
+
+    def append(self, entry: dict):
+        with self.lock:
+            entry = {"seq": self.count, "time": time.time(), **entry}
+            if self._file is None:
+                segment = self.count // LOG_SEGMENT_LINES
+                self._file = open(self._segment_path(segment), "a", encoding="utf-8")
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.tail.append(entry)
+            self.count += 1
+            if self.count % LOG_SEGMENT_LINES == 0:
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        plain = self._segment_path(self.count // LOG_SEGMENT_LINES - 1)
+        with open(plain, "rb") as src, gzip.open(plain.with_suffix(".jsonl.gz"), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        plain.unlink()
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def total(self) -> int:
+        """Entry count; recounted from disk when another process is the writer."""
+        with self.lock:
+            if self._file is None:
+                closed = len(list(self.dir.glob("*.jsonl.gz")))
+                current = self._segment_path(closed)
+                open_lines = 0
+                if current.exists():
+                    with open(current, "rb") as f:
+                        open_lines = sum(1 for _ in f)
+                self.count = closed * LOG_SEGMENT_LINES + open_lines
+            return self.count
+
+    def since(self, seq: int):
+        """Tail entries with seq >= the given value (oldest available if it fell out).
+
+        Returns (entries, next seq to ask for), both read under the lock so no
+        entry appended in between is skipped.
+        """
+        with self.lock:
+            return [entry for entry in self.tail if entry["seq"] >= seq], self.count
+
+    def _segment_lines(self, segment: int):
+        plain = self._segment_path(segment)
+        packed = plain.with_suffix(".jsonl.gz")
+        if packed.exists():
+            return gzip.open(packed, "rt", encoding="utf-8")
+        if plain.exists():
+            return open(plain, "r", encoding="utf-8")
+        return None
+
+    def read(self, offset: int, limit: int, query: str = "") -> list:
+        """Return up to limit entries from offset, optionally filtered by a substring."""
+        entries = []
+        segment, skip = divmod(max(offset, 0), LOG_SEGMENT_LINES)
+        query = query.lower()
+        # Bounded by the files on disk so readers in other processes see new entries
+        while len(entries) < limit:
+            lines = self._segment_lines(segment)
+            if lines is None:
+                break
+            with lines:
+                for line in islice(lines, skip, None):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line still being written
+                    if query and query not in entry["message"].lower():
+                        continue
+                    entries.append(entry)
+                    if len(entries) >= limit:
+                        break
+            segment += 1
+            skip = 0
+        return entries
+
+
+def open_job_log(job_id: str, create: bool = False):
+    """Return the JobLog for job_id, reopening finished jobs from disk."""
+    if not re.fullmatch(r"[0-9a-f]{12}", job_id or ""):
+        return None
+    with job_logs_lock:
+        log = job_logs.get(job_id)
+        if log is None:
+            if not create and not (LOG_DIR / job_id).is_dir():
+                return None
+            log = JobLog(job_id)
+            job_logs[job_id] = log
+            while len(job_logs) > MAX_OPEN_LOGS:
+                oldest = next(iter(job_logs))
+                if oldest == download_status.get("job_id"):
+                    job_logs.move_to_end(oldest)  # never evict the running job
+                    continue
+                job_logs.pop(oldest).close()
+        job_logs.move_to_end(job_id)
+        return log
+
+
+# ============== JOB RESULTS ==============
+
+class ResultStore:
+    """Per-track outcomes of one job, indexed by status and error class."""
+
+    def __init__(self):
+        self.rows = []
+        self.by_status = {}
+        self.by_error_class = {}
+        self.lock = threading.Lock()
+
+    def add(self, row: dict) -> dict:
+        with self.lock:
+            position = len(self.rows)
+            row = {"index": position, **row}
+            self.rows.append(row)
+            self.by_status.setdefault(row["status"], []).append(position)
+            if row.get("error_class"):
+                self.by_error_class.setdefault(row["error_class"], []).append(position)
+            return row
+
+    def query(self, status: str = "", error_class: str = "", offset: int = 0, limit: int = 100):
+        """Return (total matching, page of rows) using the narrowest index."""
+        with self.lock:
+            if error_class:
+                positions = self.by_error_class.get(error_class, [])
+                if status:
+                    positions = [p for p in positions if self.rows[p]["status"] == status]
+            elif status:
+                positions = self.by_status.get(status, [])
+            else:
+                positions = range(len(self.rows))
+            page = [self.rows[p] for p in positions[offset:offset + limit]]
+            return len(positions), page
+
+    def counts(self) -> dict:
+        with self.lock:
+            return {
+                "status": {key: len(value) for key, value in self.by_status.items()},
+                "error_class": {key: len(value) for key, value in self.by_error_class.items()},
+            }
+
+
+def open_job_results(job_id: str, create: bool = False):
+    with job_results_lock:
+        store = job_results.get(job_id)
+        if store is None and create:
+            store = job_results[job_id] = ResultStore()
+            while len(job_results) > MAX_OPEN_LOGS:
+                job_results.popitem(last=False)
+        return store
+
+
+# ============== SHARED STATE ==============
+
+class StateStore:
+    """Job queue, published job status and per-track results in SQLite (WAL).
+
+    Shared by every WSGI worker and the `--runner` service. A runner holds a
+    lease on the job it executes and renews it with every status publish; if
+    the runner dies the job is claimed again by the next one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    runner TEXT,
+                    lease_expires REAL,
+                    created REAL NOT NULL,
+                    state TEXT
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created)")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS job_results (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    error_class TEXT,
+                    row TEXT NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_results_status ON job_results (job_id, status, idx)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_results_error ON job_results (job_id, error_class, idx)")
+            db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def submit(self, params: dict, state: dict) -> str:
+        with closing(self._connect()) as db:
+            db.execute(
+                "INSERT INTO jobs (job_id, params, created, state) VALUES (?, ?, ?, ?)",
+                (state["job_id"], json.dumps(params), time.time(), json.dumps(state))
+            )
+        return state["job_id"]
+
+    def active(self) -> bool:
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT 1 FROM jobs WHERE status IN ('queued', 'running') LIMIT 1").fetchone()
+        return row is not None
+
+    def claim(self, runner: str):
+        """Take the oldest queued job, or one whose runner stopped renewing its lease."""
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT job_id, params FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                "ORDER BY created LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', runner = ?, lease_expires = ? WHERE job_id = ?",
+                    (runner, now + LEASE_SECONDS, row[0])
+                )
+            db.execute("COMMIT")
+        return (row[0], json.loads(row[1])) if row else None
+
+    def publish(self, job_id: str, runner: str, state: dict, finished: bool = False):
+        # A finished job is never reopened by a late in-flight publish
+        with closing(self._connect()) as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, lease_expires = ?, status = ? "
+                "WHERE job_id = ? AND runner = ? AND status != 'done'",
+                (json.dumps(state), time.time() + LEASE_SECONDS,
+                 "done" if finished else "running", job_id, runner)
+            )
+
+    def job(self, job_id: str):
+        """(queue status, published state) of a job, or None if it is unknown."""
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT status, state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return (row[0], json.loads(row[1]) if row[1] else {}) if row else None
+
+    def latest(self):
+        """Published state of the most recently submitted job."""
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT state FROM jobs ORDER BY created DESC LIMIT 1").fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def add_result(self, job_id: str, row: dict):
+        with closing(self._connect()) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, idx, status, error_class, row) VALUES (?, ?, ?, ?, ?)",
+                (job_id, row["index"], row["status"], row.get("error_class") or None, json.dumps(row))
+            )
+
+    def query_results(self, job_id: str, status: str = "", error_class: str = "", offset: int = 0, limit: int = 100):
+        where = "job_id = ?"
+        args = [job_id]
+        if status:
+            where += " AND status = ?"
+            args.append(status)
+        if error_class:
+            where += " AND error_class = ?"
+            args.append(error_class)
+        with closing(self._connect()) as db:
+            total = db.execute(f"SELECT COUNT(*) FROM job_results WHERE {where}", args).fetchone()[0]
+            rows = db.execute(
+                f"SELECT row FROM job_results WHERE {where} ORDER BY idx LIMIT ? OFFSET ?",
+                args + [limit, offset]
+            ).fetchall()
+            counts = {"status": {}, "error_class": {}}
+            for column in ("status", "error_class"):
+                for value, count in db.execute(
+                    f"SELECT {column}, COUNT(*) FROM job_results WHERE job_id = ? AND {column} IS NOT NULL "
+                    f"GROUP BY {column}", (job_id,)
+                ):
+                    counts[column][value] = count
+        return total, [json.loads(row[0]) for row in rows], counts
+
+    def get_setting(self, key: str):
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_setting(self, key: str, value):
+        with closing(self._connect()) as db:
+            db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+
+def state_store():
+    global state_store_instance
+    if state_store_instance is None:
+        state_store_instance = StateStore(STATE_DB)
+    return state_store_instance
+
+
+def run_job_runner(state_path: str):
+    """Job runner service: claim queued jobs and execute them, publishing status."""
+    global STATE_DB
+    STATE_DB = state_path
+    store = state_store()
+    runner = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Runner {runner} polling {state_path}")
+    
+    while True:
+        claimed = store.claim(runner)
+        if claimed is None:
+            time.sleep(2.0)
+            continue
+        job_id, params = claimed
+        
+        stop = threading.Event()
+        def publisher():
+            while not stop.wait(STATE_PUBLISH_INTERVAL):
+                settings = store.get_setting("bandwidth")
+                if settings:
+                    bandwidth_configure(settings.get("limit"), settings.get("weights"))
+                if download_status.get("job_id") == job_id:
+                    store.publish(job_id, runner, status_snapshot())
+        publisher_thread = threading.Thread(target=publisher, daemon=True)
+        publisher_thread.start()
+        
+        try:
+            download_worker(**params, job_id=job_id)
+        finally:
+            stop.set()
+            publisher_thread.join()
+            store.publish(job_id, runner, status_snapshot(), finished=True)
+        print(f"Finished job {job_id}")
+
+
+# ============== PLAYLIST WATCHER ==============
+
+def _watch_poll(sp, url: str):
+    kind, playlist_id = parse_spotify_url(url)
+    if kind != "playlist":
+        raise ValueError(f"Only playlists can be watched, got a {kind} URL")
+    return sp.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+
+
+def _watch_retryable(job_id: str) -> int:
+    """Failed tracks of a sync that a later sync could still fetch.
+
+    Permanent failures (unavailable, no results, ffmpeg) fail the same way
+    every time, so they don't hold the snapshot back.
+    """
+    if STATE_DB:
+        count = lambda **where: state_store().query_results(job_id, limit=0, **where)[0]
+    else:
+        store = open_job_results(job_id)
+        if store is None:
+            return download_status["failed_count"]
+        count = lambda **where: store.query(limit=0, **where)[0]
+    return count(status="failed") - sum(count(status="failed", error_class=c) for c in PERMANENT_ERRORS)
+
+
+def _watch_settle(state: dict):
+    """Advance the snapshot of playlists whose queued sync has finished cleanly."""
+    for url, entry in state.items():
+        if not entry.get("pending_job"):
+            continue
+        job = state_store().job(entry["pending_job"])
+        if job and job[0] != "done":
+            continue
+        if job and not job[1].get("job_error") and not _watch_retryable(entry["pending_job"]):
+            entry["snapshot"] = entry["pending_snapshot"]
+            print(f"Synced {url}")
+        else:
+            print(f"Sync {entry['pending_job']} for {url} did not finish cleanly, will retry")
+        entry.pop("pending_job")
+        entry.pop("pending_snapshot", None)
+
+
+def run_watcher(watch_path: str):
+    """Watch daemon: sync playlists whose snapshot_id changed since the last poll.
+
+    watch.json holds client_id, client_secret and defaults (output_dir,
+    browser, engine, interval) plus "playlists", a list of {"url", ...}
+    entries that may override any default. Last-seen snapshots and
+    next poll times live in <watch file>.state.json. With a state
+    database the syncs are queued for runners and a snapshot only advances
+    once a later cycle sees its job done; otherwise they run here.
+    """
+    config = json.loads(Path(watch_path).read_text(encoding="utf-8"))
+    state_file = Path(watch_path).with_suffix(".state.json")
+    state = json.loads(state_file.read_text(encoding="utf-8")) if state_file.exists() else {}
+    sp = get_spotify_client(config["client_id"], config["client_secret"])
+    defaults = {
+        "output_dir": config.get("output_dir", "downloads"),
+        "browser": config.get("browser", "none"),
+        "engine": config.get("engine", "auto"),
+        "interval": config.get("interval", WATCH_INTERVAL),
+    }
+    playlists = [{**defaults, **entry} for entry in config["playlists"]]
+    print(f"Watching {len(playlists)} playlists from {watch_path}")
+    
+    while True:
+        started = time.monotonic()
+        now = time.time()
+        if STATE_DB:
+            _watch_settle(state)
+        # A playlist with a queued sync is left alone until that job finishes
+        due = [
+            p for p in playlists
+            if state.get(p["url"], {}).get("next", 0) <= now and not state.get(p["url"], {}).get("pending_job")
+        ]
+        with ThreadPoolExecutor(max_workers=WATCH_CONCURRENCY) as pool:
+            futures = {pool.submit(_watch_poll, sp, p["url"]): p for p in due}
+            changed = []
+            for future in as_completed(futures):
+                playlist = futures[future]
+                entry = state.setdefault(playlist["url"], {})
+                entry["next"] = now + playlist["interval"] * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+                try:
+                    snapshot = future.result()
+                except Exception as e:
+                    print(f"Poll failed for {playlist['url']}: {clean_error_message(str(e))[:80]}")
+                    continue
+                if snapshot != entry.get("snapshot"):
+                    changed.append((playlist, snapshot))
+        if due:
+            print(f"Polled {len(due)} playlists in {time.monotonic() - started:.1f}s, {len(changed)} changed")
+        
+        for playlist, snapshot in changed:
+            params = {
+                "client_id": config["client_id"], "client_secret": config["client_secret"],
+                "playlist_url": playlist["url"], "output_dir": playlist["output_dir"],
+                "browser": playlist["browser"], "engine": playlist["engine"], "mode": "download",
+            }
+            if STATE_DB:
+                job_state = new_job_status(engine=playlist["engine"])
+                job_state["current_track"] = "Waiting for a runner..."
+                state_store().submit(params, job_state)
+                state[playlist["url"]]["pending_job"] = job_state["job_id"]
+                state[playlist["url"]]["pending_snapshot"] = snapshot
+                print(f"Queued sync {job_state['job_id']} for {playlist['url']}")
+                continue
+            download_worker(**params)
+            # Keep the old snapshot after any failure so the next poll retries
+            if download_status["job_error"]:
+                print(f"Sync failed for {playlist['url']}: {download_status['job_error']}")
+                continue
+            if not _watch_retryable(download_status["job_id"]):
+                state[playlist["url"]]["snapshot"] = snapshot
+            print(f"Synced {playlist['url']}: {download_status['completed_count']} ok, "
+                  f"{download_status['failed_count']} failed")
+        
+        tmp_file = state_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(state), encoding="utf-8")
+        os.replace(tmp_file, state_file)
+        
+        upcoming = min((state.get(p["url"], {}).get("next", 0) for p in playlists), default=time.time() + 60)
+        time.sleep(min(max(upcoming - time.time(), 1.0), 60.0))
+
+
+# ============== JOB HISTORY ==============
+
+class HistoryStore:
+    """Finished and running jobs plus every track outcome, indexed for lookups.
+
+    Rows are written as each track is recorded, so the index is current while
+    a job runs and survives restarts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS history_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    sources TEXT NOT NULL,
+                    name TEXT,
+                    output_dir TEXT,
+                    mode TEXT,
+                    total INTEGER,
+                    completed INTEGER,
+                    failed INTEGER,
+                    started REAL NOT NULL,
+                    finished REAL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_history_started ON history_jobs (started)")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tracks (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    spotify_id TEXT,
+                    isrc TEXT,
+                    track TEXT COLLATE NOCASE,
+                    artist TEXT COLLATE NOCASE,
+                    status TEXT NOT NULL,
+                    error_class TEXT,
+                    error TEXT,
+                    note TEXT,
+                    video_url TEXT,
+                    seconds REAL,
+                    recorded REAL NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_artist ON tracks (artist, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_artist_status ON tracks (artist, status, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_track ON tracks (track, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_status ON tracks (status, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_error ON tracks (error_class, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_spotify ON tracks (spotify_id, recorded)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_tracks_recorded ON tracks (recorded)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def start_job(self, job_id: str, sources: list, name: str, output_dir: str, mode: str, total: int):
+        with closing(self._connect()) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO history_jobs (job_id, sources, name, output_dir, mode, total, started) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(sources), name, output_dir, mode, total, time.time())
+            )
+
+    def finish_job(self, job_id: str, completed: int, failed: int):
+        with closing(self._connect()) as db:
+            db.execute(
+                "UPDATE history_jobs SET completed = ?, failed = ?, finished = ? WHERE job_id = ?",
+                (completed, failed, time.time(), job_id)
+            )
+
+    def add_track(self, job_id: str, row: dict, track_info: dict, result: dict):
+        with closing(self._connect()) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tracks (job_id, idx, spotify_id, isrc, track, artist, status, "
+                "error_class, error, note, video_url, seconds, recorded) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, row["index"], track_info.get("id"), track_info.get("isrc"),
+                 track_info["track"], track_info["artist"], result["status"],
+                 result.get("error_class") or None, result["error"] or None, result["note"] or None,
+                 result.get("video_url") or track_info.get("video_url") or None,
+                 result.get("seconds"), time.time())
+            )
+
+    def jobs(self, offset: int = 0, limit: int = 50):
+        with closing(self._connect()) as db:
+            total = db.execute("SELECT COUNT(*) FROM history_jobs").fetchone()[0]
+            cursor = db.execute(
+                "SELECT job_id, sources, name, output_dir, mode, total, completed, failed, started, finished "
+                "FROM history_jobs ORDER BY started DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            )
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor]
+        for row in rows:
+            row["sources"] = json.loads(row["sources"])
+        return total, rows
+
+    def tracks(self, filters: dict, since: float = 0, offset: int = 0, limit: int = 100):
+        """Track outcomes across all jobs, newest first.
+
+        filters maps artist/track/status/error_class/spotify_id/job_id to exact
+        values (artist and track are case-insensitive).
+        """
+        where = ["t.recorded >= ?"]
+        args = [since]
+        for column, value in filters.items():
+            if value:
+                where.append(f"t.{column} = ?")
+                args.append(value)
+        clause = " AND ".join(where)
+        with closing(self._connect()) as db:
+            total = db.execute(f"SELECT COUNT(*) FROM tracks t WHERE {clause}", args).fetchone()[0]
+            cursor = db.execute(
+                f"SELECT t.*, j.name AS job_name, j.sources AS job_sources FROM tracks t "
+                f"LEFT JOIN history_jobs j ON j.job_id = t.job_id "
+                f"WHERE {clause} ORDER BY t.recorded DESC LIMIT ? OFFSET ?",
+                args + [limit, offset]
+            )
+            columns = [c[0] for c in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor]
+        for row in rows:
+            row["job_sources"] = json.loads(row["job_sources"]) if row["job_sources"] else []
+        return total, rows
+
+
+HISTORY_FILTERS = ("artist", "track", "status", "error_class", "spotify_id", "job_id")
+
+
+def history_store():
+    global history_store_instance
+    if history_store_instance is None:
+        history_store_instance = HistoryStore(HISTORY_DB)
+    return history_store_instance
+
+
+# ============== SPOTIFY CLIENTS ==============
+
+class SpotifyRateLimiter:
+    """Spaces out API calls and pauses every caller after a 429 Retry-After."""
+
+    def __init__(self, min_interval: float = 0.05):
+        self.min_interval = min_interval
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+
+class SharedSpotify(spotipy.Spotify):
+    """spotipy client that routes every request through a shared rate limiter."""
+
+    max_rate_limit_retries = 5
+
+    def __init__(self, limiter: SpotifyRateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def _internal_call(self, method, url, payload, params):
+        for attempt in range(self.max_rate_limit_retries + 1):
+            self.limiter.wait()
+            try:
+                return super()._internal_call(method, url, payload, params)
+            except spotipy.SpotifyException as e:
+                if e.http_status != 429 or attempt == self.max_rate_limit_retries:
+                    raise
+                headers = getattr(e, "headers", None) or {}
+                try:
+                    retry_after = float(headers.get("Retry-After", 1))
+                except (TypeError, ValueError):
+                    retry_after = 1.0
+                self.limiter.pause(retry_after)
+
+
+def get_spotify_client(client_id: str, client_secret: str) -> spotipy.Spotify:
+    """Return the process-wide client for these credentials, creating it once.
+
+    The token is cached in memory until it expires and all jobs share one
+    keep-alive connection pool and rate limiter.
+    """
+    with spotify_clients_lock:
+        entry = spotify_clients.get(client_id)
+        if entry and entry["secret"] == client_secret:
+            return entry["client"]
+        
+        # spotipy skips its own retry setup for a caller-supplied session, so
+        # 5xx retries live on the adapter; 429s are left to SharedSpotify so
+        # the Retry-After wait is shared across jobs
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=3,
+            status=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        http.mount("https://", adapter)
+        auth_manager = SpotifyClientCredentials(
+            client_id=client_id,
+            client_secret=client_secret,
+            cache_handler=MemoryCacheHandler(),
+            requests_session=http
+        )
+        client = SharedSpotify(
+            SpotifyRateLimiter(),
+            auth_manager=auth_manager,
+            requests_session=http
+        )
+        spotify_clients[client_id] = {"secret": client_secret, "client": client}
+        return client
+
+
+# ============== BANDWIDTH ==============
+
+def _bandwidth_rebalance():
+    """Push each slot's share of the global cap into its live yt-dlp params."""
+    limit = bandwidth["limit"]
+    jobs = {}
+    for slot in bandwidth["slots"]:
+        jobs.setdefault(slot["job"], []).append(slot)
+    total_weight = sum(bandwidth["weights"].get(job, 1.0) for job in jobs)
+    for job, slots in jobs.items():
+        share = None
+        if limit > 0:
+            job_share = limit * bandwidth["weights"].get(job, 1.0) / total_weight
+            share = max(int(job_share / len(slots)), 1024)
+        for slot in slots:
+            if slot["params"] is not None:
+                # Every fragment thread applies the full ratelimit on its own
+                threads = slot["params"].get("concurrent_fragment_downloads") or 1
+                slot["params"]["ratelimit"] = max(share // threads, 1024) if share else None
+
+
+def bandwidth_acquire(job_id: str) -> dict:
+    """Register an active download. Call bandwidth_attach once the YoutubeDL exists."""
+    slot = {"job": job_id, "params": None, "speed": 0}
+    with bandwidth_lock:
+        bandwidth["slots"].append(slot)
+        _bandwidth_rebalance()
+    return slot
+
+
+def bandwidth_attach(slot: dict, params: dict):
+    # The native downloader reads params["ratelimit"] on every chunk, so updating
+    # the dict in place throttles a download that is already running. Fragment
+    # downloads copy the params when they start and keep the share they got then.
+    with bandwidth_lock:
+        slot["params"] = params
+        _bandwidth_rebalance()
+
+
+def bandwidth_release(slot: dict):
+    with bandwidth_lock:
+        if slot in bandwidth["slots"]:
+            bandwidth["slots"].remove(slot)
+        _bandwidth_rebalance()
+
+
+def bandwidth_hook(slot: dict):
+    """yt-dlp progress hook recording the slot's current transfer rate."""
+    def hook(d):
+        if d.get("status") == "downloading":
+            slot["speed"] = d.get("speed") or 0
+        else:
+            slot["speed"] = 0
+    return hook
+
+
+def bandwidth_configure(limit=None, weights=None):
+    with bandwidth_lock:
+        if limit is not None:
+            bandwidth["limit"] = max(int(limit), 0)
+        if weights:
+            bandwidth["weights"].update({job: max(float(w), 0.01) for job, w in weights.items()})
+        _bandwidth_rebalance()
+
+
+def bandwidth_usage() -> dict:
+    with bandwidth_lock:
+        jobs = {}
+        for slot in bandwidth["slots"]:
+            job = jobs.setdefault(slot["job"], {
+                "weight": bandwidth["weights"].get(slot["job"], 1.0),
+                "downloads": 0,
+                "used": 0,
+            })
+            job["downloads"] += 1
+            job["used"] += int(slot["speed"])
+        return {
+            "limit": bandwidth["limit"],
+            "used": sum(job["used"] for job in jobs.values()),
+            "jobs": jobs,
+        }
+
+
+def effective_bitrate(fmt: dict) -> float:
+    """Audio bitrate of a format in MP3-equivalent kbps."""
+    codec = (fmt.get("acodec") or "").split(".")[0].lower()
+    return (fmt.get("abr") or fmt.get("tbr") or 0) * CODEC_EFFICIENCY.get(codec, 1.0)
+
+
+def pick_audio_format(formats: list):
+    """Smallest audio-only format at or above TARGET_BITRATE, else the best below it.
+
+    Without any audio-only format, the smallest format that carries audio is
+    used instead of a full video download. Formats with an unknown acodec
+    (generic extractors, local files) are the last resort. Returns None when
+    nothing can have audio.
+    """
+    with_audio = [f for f in formats if f.get("acodec") not in (None, "none")]
+    audio_only = [f for f in with_audio if f.get("vcodec") == "none"]
+    if not audio_only:
+        sized = [f for f in with_audio if f.get("filesize") or f.get("filesize_approx") or f.get("tbr")]
+        if not sized:
+            if with_audio:
+                return with_audio[0]
+            unknown = [f for f in formats if f.get("acodec") is None]
+            # yt-dlp lists formats worst first
+            return unknown[-1] if unknown else None
+        return min(sized, key=lambda f: f.get("filesize") or f.get("filesize_approx") or f["tbr"] * 1e6)
+    enough = [f for f in audio_only if effective_bitrate(f) >= TARGET_BITRATE]
+    if enough:
+        return min(enough, key=effective_bitrate)
+    return max(audio_only, key=effective_bitrate)
+
+
+def select_audio_format(ctx: dict):
+    """yt-dlp format selector wrapping pick_audio_format()."""
+    fmt = pick_audio_format(ctx.get("formats") or [])
+    if fmt is not None:
+        yield fmt
+
+
+def build_ydl_opts(output_template: str) -> dict:
+    """Enhanced yt-dlp options shared by every track download."""
+    return {
+        "default_search": "ytsearch1",
+        "format": select_audio_format,
+        "postprocessors": [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "mp3",
+            "preferredquality": str(TARGET_BITRATE),
+        }],
+        "outtmpl": output_template,
+        "quiet": True,
+        "no_warnings": True,
+        "ignoreerrors": False,
+        "noplaylist": True,
+        "overwrites": False,
+        "http_headers": {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "en-us,en;q=0.5",
+        },
+        "retries": 3,
+        "fragment_retries": 3,
+        "socket_timeout": 30,
+        "extractor_args": {
+            "youtube": {
+                "player_client": preferred_clients(),
+            }
+        },
+    }
+
+
+# ============== DOWNLOAD ENGINES ==============
+
+def _engine_native(ydl_opts: dict):
+    pass
+
+
+def _engine_fragments(ydl_opts: dict):
+    ydl_opts["concurrent_fragment_downloads"] = FRAGMENT_CONCURRENCY
+
+
+def _engine_aria2c(ydl_opts: dict):
+    ydl_opts["external_downloader"] = {"default": "aria2c"}
+    ydl_opts["external_downloader_args"] = {
+        "aria2c": ["-x", str(ARIA2C_CONNECTIONS), "-s", str(ARIA2C_CONNECTIONS), "-k", "1M"]
+    }
+
+
+# name -> (applies the engine to ydl_opts, is it usable here)
+DOWNLOAD_ENGINES = {
+    "aria2c": (_engine_aria2c, lambda: shutil.which("aria2c") is not None),
+    "fragments": (_engine_fragments, lambda: True),
+    "native": (_engine_native, lambda: True),
+}
+
+
+def engine_chain(preferred: str) -> list:
+    """Engines to try for a job: the preferred one, then the remaining fallbacks.
+
+    Only the native engine follows /bandwidth changes live; aria2c and the
+    fragment threads keep the rate limit they started with. While a cap is set
+    "auto" therefore tries native first.
+    """
+    order = list(DOWNLOAD_ENGINES)
+    if preferred not in DOWNLOAD_ENGINES and bandwidth["limit"] > 0:
+        order.remove("native")
+        order.insert(0, "native")
+    if preferred in DOWNLOAD_ENGINES:
+        order.remove(preferred)
+        order.insert(0, preferred)
+    return [name for name in order if DOWNLOAD_ENGINES[name][1]()]
+
+
+def run_engines(ydl_opts: dict, url, job_id: str, engines: list, watch: dict = None):
+    """Download url (or an already extracted info dict) with each engine in turn."""
+    last_exc = None
+    for name in engines:
+        if watch and watch["cancel"]:
+            raise DownloadCancelled(watch["cancel"])
+        opts = dict(ydl_opts)
+        DOWNLOAD_ENGINES[name][0](opts)
+        slot = bandwidth_acquire(job_id)
+        opts["progress_hooks"] = [bandwidth_hook(slot)]
+        if watch:
+            opts["progress_hooks"].append(watchdog_hook(watch))
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                bandwidth_attach(slot, ydl.params)
+                if watch:
+                    watchdog_attempt(watch, ydl.params)
+                if isinstance(url, dict):
+                    ydl.process_ie_result(copy.deepcopy(url), download=True)
+                else:
+                    ydl.download([url])
+            return name
+        except Exception as e:
+            last_exc = e
+            if watch and watch["cancel"]:
+                break
+            if classify_error(clean_error_message(str(e))) in SOURCE_ERRORS:
+                break
+        finally:
+            bandwidth_release(slot)
+    raise last_exc
+
+
+def run_bench(url: str, runs: int = 3) -> dict:
+    """Download url with every usable engine `runs` times and compare throughput.
+
+    Only the transfer is timed (no transcode); files go to a temp dir.
+    """
+    report = {}
+    for name, (_, usable) in DOWNLOAD_ENGINES.items():
+        if not usable():
+            report[name] = {"error": "not available"}
+            continue
+        timings = []
+        sizes = []
+        try:
+            for _ in range(runs):
+                work_dir = Path(tempfile.mkdtemp(prefix="spotidown-bench-"))
+                try:
+                    ydl_opts = build_ydl_opts(str(work_dir / "bench.%(ext)s"))
+                    ydl_opts["postprocessors"] = []
+                    started = time.monotonic()
+                    run_engines(ydl_opts, url, "bench", [name])
+                    timings.append(time.monotonic() - started)
+                    sizes.append(sum(f.stat().st_size for f in work_dir.iterdir()))
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+        except Exception as e:
+            report[name] = {"error": clean_error_message(str(e))[:200]}
+            continue
+        median = sorted(timings)[len(timings) // 2]
+        report[name] = {
+            "runs": runs,
+            "median_s": round(median, 2),
+            "bytes": sizes[0],
+            "mb_per_s": round(sorted(sizes)[len(sizes) // 2] / median / 1e6, 2) if median else None,
+        }
+    return report
+
+
+# ============== PLAYER CLIENT RACING ==============
+
+def reset_client_stats():
+    global race_counter
+    with client_stats_lock:
+        client_stats.clear()
+        race_counter = 0
+
+
+def _client_record(client: str, success: bool, latency: float):
+    with client_stats_lock:
+        stats = client_stats.setdefault(client, {"attempts": 0, "successes": 0, "wins": 0, "latency": None})
+        stats["attempts"] += 1
+        if success:
+            stats["successes"] += 1
+            previous = stats["latency"]
+            stats["latency"] = latency if previous is None else 0.8 * previous + 0.2 * latency
+
+
+def preferred_clients() -> list:
+    """PLAYER_CLIENTS ordered by how often each has won a race."""
+    with client_stats_lock:
+        return sorted(
+            PLAYER_CLIENTS,
+            key=lambda client: -client_stats.get(client, {}).get("wins", 0)
+        )
+
+
+def race_plan() -> list:
+    """Clients to race for the next track: all of them, or just a clear favourite."""
+    global race_counter
+    with client_stats_lock:
+        race_counter += 1
+        explore = race_counter % RACE_EXPLORE_EVERY == 0
+        total_wins = sum(stats["wins"] for stats in client_stats.values())
+    clients = preferred_clients()
+    if not explore and total_wins >= RACE_EXPLORE_EVERY:
+        leader = client_stats[clients[0]]
+        if leader["wins"] / total_wins >= 0.8 and leader["successes"] / leader["attempts"] >= 0.9:
+            return clients[:1]
+    return clients
+
+
+def _extract_with_client(search_query: str, ydl_opts: dict, client: str) -> dict:
+    opts = dict(ydl_opts)
+    opts["extractor_args"] = {"youtube": {"player_client": [client]}}
+    started = time.monotonic()
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(f"ytsearch1:{search_query}", download=False)
+        entries = [entry for entry in (info or {}).get("entries") or [] if entry]
+        if not entries or not entries[0].get("formats"):
+            raise ValueError(f"No results from the {client} client")
+    except Exception:
+        _client_record(client, False, time.monotonic() - started)
+        raise
+    _client_record(client, True, time.monotonic() - started)
+    return entries[0]
+
+
+def race_extract(search_query: str, ydl_opts: dict):
+    """Extract the search result with several player clients at once.
+
+    Returns (winning client, info dict) for the first valid result; raises the
+    last error when every client fails.
+    """
+    clients = race_plan()
+    pool = ThreadPoolExecutor(max_workers=len(clients))
+    futures = {
+        pool.submit(_extract_with_client, search_query, ydl_opts, client): client
+        for client in clients
+    }
+    pool.shutdown(wait=False)  # losers finish in the background and still count
+    last_exc = None
+    for future in as_completed(futures):
+        try:
+            info = future.result()
+        except Exception as e:
+            last_exc = e
+            continue
+        client = futures[future]
+        with client_stats_lock:
+            client_stats[client]["wins"] += 1
+        return client, info
+    raise last_exc
+
+
+def client_report() -> dict:
+    with client_stats_lock:
+        return {
+            client: {
+                "attempts": stats["attempts"],
+                "wins": stats["wins"],
+                "success_rate": round(stats["successes"] / stats["attempts"], 3) if stats["attempts"] else None,
+                "latency_ms": round(stats["latency"] * 1000) if stats["latency"] is not None else None,
+            }
+            for client, stats in client_stats.items()
+        }
+
+
+# ============== WATCHDOG ==============
+
+def watchdog_register() -> dict:
+    """Start watching a track download; the watchdog thread checks it every second."""
+    global watchdog_thread
+    watch = {
+        "started": time.monotonic(),
+        "bytes": 0,
+        "window_start": time.monotonic(),
+        "window_bytes": 0,
+        "params": None,
+        "abort": "",   # one-shot: cancels the current engine attempt
+        "cancel": "",  # terminal: cancels every remaining attempt
+    }
+    with watchdog_lock:
+        watchdog_watches.append(watch)
+        if watchdog_thread is None:
+            watchdog_thread = threading.Thread(target=_watchdog_loop, daemon=True)
+            watchdog_thread.start()
+    return watch
+
+
+def watchdog_unregister(watch: dict):
+    with watchdog_lock:
+        if watch in watchdog_watches:
+            watchdog_watches.remove(watch)
+
+
+def watchdog_attempt(watch: dict, params: dict):
+    """Reset the throughput window for a new engine/cookie attempt."""
+    watch["params"] = params
+    watch["bytes"] = 0
+    watch["window_bytes"] = 0
+    watch["window_start"] = time.monotonic()
+    watch["abort"] = ""
+
+
+def watchdog_hook(watch: dict):
+    """yt-dlp progress hook that feeds the watchdog and carries out its verdicts."""
+    def hook(d):
+        if d.get("status") == "downloading":
+            watch["bytes"] = d.get("downloaded_bytes") or 0
+        info = d.get("info_dict") or {}
+        if info.get("webpage_url"):
+            watch["url"] = info["webpage_url"]
+        reason = watch["cancel"] or watch["abort"]
+        if reason:
+            watch["abort"] = ""
+            raise DownloadCancelled(reason)
+    return hook
+
+
+def _watchdog_loop():
+    while True:
+        time.sleep(1.0)
+        now = time.monotonic()
+        with watchdog_lock:
+            watches = list(watchdog_watches)
+        for watch in watches:
+            if now - watch["started"] > TRACK_TIME_BUDGET:
+                watch["cancel"] = f"stalled: over the {TRACK_TIME_BUDGET:.0f}s time budget"
+                continue
+            window = now - watch["window_start"]
+            if window < THROUGHPUT_WINDOW:
+                continue
+            rate = (watch["bytes"] - watch["window_bytes"]) / window
+            watch["window_start"] = now
+            watch["window_bytes"] = watch["bytes"]
+            # Don't punish downloads that the bandwidth cap is deliberately slowing
+            floor = MIN_THROUGHPUT
+            ratelimit = (watch["params"] or {}).get("ratelimit")
+            if ratelimit:
+                floor = min(floor, ratelimit / 2)
+            if watch["bytes"] and rate < floor:
+                watch["abort"] = f"stalled: too slow ({rate / 1024:.1f} KB/s)"
+
+
+def record_latency(seconds: float):
+    with watchdog_lock:
+        download_latencies.append(seconds)
+
+
+def latency_p95():
+    """95th percentile of recent successful track downloads, or None without enough data."""
+    with watchdog_lock:
+        samples = sorted(download_latencies)
+    if len(samples) < 10:
+        return None
+    return samples[int(len(samples) * 0.95) - 1]
+
+
+def run_hedged(attempt, variants: list, hedge_after):
+    """Run attempt(variant, watch) for variants[0], adding variants[1] as a hedge
+    once hedge_after seconds pass. The first success wins and the loser is
+    cancelled; this returns only after every attempt has stopped, so callers
+    can clean up the loser's files.
+
+    A stalled socket or a hung search never reaches the progress hooks, so
+    attempts still running a socket timeout after TRACK_TIME_BUDGET are
+    abandoned (their threads are daemons and stop at the next hook).
+
+    Returns (winning variant or None, success, last_error).
+    """
+    results = queue.Queue()
+    watches = []
+    
+    def launch(variant):
+        watch = watchdog_register()
+        watches.append(watch)
+        def run():
+            try:
+                outcome = attempt(variant, watch)
+            except Exception as e:
+                outcome = (False, clean_error_message(str(e)))
+            finally:
+                watchdog_unregister(watch)
+            results.put((variant, watch, outcome))
+        threading.Thread(target=run, daemon=True).start()
+    
+    launch(variants[0])
+    pending = 1
+    started = time.monotonic()
+    deadline = started + TRACK_TIME_BUDGET + WATCHDOG_SOCKET_TIMEOUT
+    hedged = hedge_after is None or len(variants) < 2
+    last_error = ""
+    while pending:
+        timeout = max(deadline - time.monotonic(), 0)
+        if not hedged:
+            timeout = min(timeout, max(hedge_after - (time.monotonic() - started), 0))
+        try:
+            variant, watch, (success, error) = results.get(timeout=timeout)
+        except queue.Empty:
+            if time.monotonic() >= deadline:
+                for other in watches:
+                    other["cancel"] = f"stalled: over the {TRACK_TIME_BUDGET:.0f}s time budget"
+                return None, False, f"stalled: over the {TRACK_TIME_BUDGET:.0f}s time budget"
+            hedged = True
+            add_log(f"⏱ Slower than p95 ({hedge_after:.0f}s), starting a hedged attempt", "info")
+            launch(variants[1])
+            pending += 1
+            continue
+        pending -= 1
+        if success:
+            for other in watches:
+                if other is not watch:
+                    other["cancel"] = "hedge lost"
+            # The cancel flag is only seen by progress hooks; a loser in
+            # postprocessing runs to the end, so wait for it (within the budget)
+            for _ in range(pending):
+                try:
+                    results.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            return variant, True, ""
+        last_error = error or last_error
+    return None, False, last_error
+
+
+ATTEMPT_FILE_SUFFIX = re.compile(r"(hedge\.)?(f[\w-]+\.)?\w+(\.part(-Frag\d+)?|\.ytdl|\.temp)?")
+
+
+def remove_attempt_files(outtmpl: str, keep: Path = None):
+    """Delete every file an attempt wrote for this template (.part, containers, mp3)."""
+    base = Path(outtmpl.replace(".%(ext)s", ""))
+    for path in base.parent.glob(glob.escape(base.name) + ".*"):
+        # Only yt-dlp's own suffixes, never another track that shares the prefix
+        rest = path.name[len(base.name) + 1:]
+        if path != keep and ATTEMPT_FILE_SUFFIX.fullmatch(rest):
+            path.unlink(missing_ok=True)
+
+
+def download_track(search_query: str, output_template: str, browser: str, job_id: str = "",
+                   engine: str = "auto", video_url: str = ""):
+    """Search YouTube and download one track.
+
+    Returns (success, last_error, URL of the video that was downloaded).
+
+    The watchdog cancels attempts that run out of time or throughput; with
+    HEDGE_DOWNLOADS a second attempt (other format and player client, separate
+    file) races the first once it is slower than the recent p95.
+    """
+    engines = engine_chain(engine)
+    variants = [{"outtmpl": output_template}]
+    if HEDGE_DOWNLOADS:
+        variants.append({
+            "outtmpl": output_template.replace(".%(ext)s", ".hedge.%(ext)s"),
+            "format": "bestaudio[ext=m4a]/bestaudio",
+            "player_client": ["web"],
+        })
+    
+    started = time.monotonic()
+    winner, success, last_error = run_hedged(
+        lambda variant, watch: _download_variant(search_query, variant, browser, job_id, engines, watch, video_url),
+        variants,
+        latency_p95() if HEDGE_DOWNLOADS else None
+    )
+    if success:
+        record_latency(time.monotonic() - started)
+        if winner is not variants[0]:
+            hedge_file = Path(winner["outtmpl"].replace("%(ext)s", "mp3"))
+            remove_attempt_files(output_template, keep=hedge_file)
+            if hedge_file.exists():
+                os.replace(hedge_file, output_template.replace("%(ext)s", "mp3"))
+        elif len(variants) > 1:
+            remove_attempt_files(variants[1]["outtmpl"])
+    return success, last_error, winner.get("url", "") if winner else ""
+
+
+def _download_variant(search_query: str, variant: dict, browser: str, job_id: str, engines: list, watch: dict,
+                      video_url: str = ""):
+    ydl_opts = build_ydl_opts(variant["outtmpl"])
+    if "format" in variant:
+        ydl_opts["format"] = variant["format"]
+    if "player_client" in variant:
+        ydl_opts["extractor_args"] = {"youtube": {"player_client": variant["player_client"]}}
+    last_error = ""
+    
+    # Try with selected browser, then fallback to no cookies
+    browsers_to_try = []
+    if browser != "none":
+        browsers_to_try.append(browser)
+    browsers_to_try.append(None)  # Last resort: no cookies
+    
+    for attempt_browser in browsers_to_try:
+        try:
+            if attempt_browser:
+                # Only set cookies if we have a browser
+                ydl_opts["cookiesfrombrowser"] = (attempt_browser,)
+                # Reduce timeout for cookie attempts
+                ydl_opts["socket_timeout"] = 10
+            else:
+                ydl_opts.pop("cookiesfrombrowser", None)
+                ydl_opts["socket_timeout"] = WATCHDOG_SOCKET_TIMEOUT
+            
+            target = video_url or f"ytsearch1:{search_query}"
+            if RACE_CLIENTS and not video_url and "player_client" not in variant:
+                client, target = race_extract(search_query, ydl_opts)
+                ydl_opts["extractor_args"] = {"youtube": {"player_client": [client]}}
+            run_engines(ydl_opts, target, job_id, engines, watch)
+            variant["url"] = watch.get("url", "")
+            return True, ""
+            
+        except Exception as e:
+            last_error = clean_error_message(str(e))
+            if watch["cancel"]:
+                break
+            # Permanent failures won't be fixed by dropping cookies
+            if classify_error(last_error) in PERMANENT_ERRORS:
+                break
+            # Log the specific browser failure but don't stop unless all fail
+            if attempt_browser:
+                add_log(f"Warning: Failed to use {attempt_browser} cookies: {last_error[:50]}...", "info")
+            continue
+    
+    return False, last_error
+
+
+# ============== JOB BROKER ==============
+
+class SQLiteBroker:
+    """Work queue in a SQLite file shared by the web node and remote workers.
+
+    Workers lease an item for LEASE_SECONDS and keep it alive with heartbeats.
+    An expired lease means the worker died and the item is handed out again,
+    up to MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS work_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    reported INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_work_status ON work_items (status, lease_expires)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_work_job ON work_items (job_id, reported)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, job_id: str, payloads: list):
+        with closing(self._connect()) as db:
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT INTO work_items (job_id, payload) VALUES (?, ?)",
+                [(job_id, json.dumps(payload)) for payload in payloads]
+            )
+            db.execute("COMMIT")
+
+    def lease(self, worker: str):
+        """Claim the next queued (or abandoned) item. Returns (id, payload) or None."""
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            self._expire_dead(db, now)
+            row = db.execute(
+                "SELECT id, payload FROM work_items "
+                "WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE work_items SET status = 'leased', worker = ?, lease_expires = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + LEASE_SECONDS, row[0])
+                )
+            db.execute("COMMIT")
+        return (row[0], json.loads(row[1])) if row else None
+
+    @staticmethod
+    def _expire_dead(db, now: float):
+        """Give up on items whose worker died MAX_ATTEMPTS times (call inside a transaction)."""
+        db.execute(
+            "UPDATE work_items SET status = 'failed', result = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (json.dumps({
+                "status": "failed", "error": "worker lost", "error_class": "worker_lost",
+                "note": "", "log": []
+            }), now, MAX_ATTEMPTS)
+        )
+
+    def heartbeat(self, item_id: int, worker: str) -> bool:
+        with closing(self._connect()) as db:
+            cur = db.execute(
+                "UPDATE work_items SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + LEASE_SECONDS, item_id, worker)
+            )
+            return cur.rowcount == 1
+
+    def complete(self, item_id: int, worker: str, result: dict):
+        with closing(self._connect()) as db:
+            db.execute(
+                "UPDATE work_items SET status = ?, result = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (result["status"], json.dumps(result), item_id, worker)
+            )
+
+    def collect(self, job_id: str) -> list:
+        """Return finished, not yet reported (payload, result) pairs for a job."""
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Without this, items of dead workers only expire when another worker leases
+            self._expire_dead(db, time.time())
+            rows = db.execute(
+                "SELECT id, payload, result FROM work_items "
+                "WHERE job_id = ? AND reported = 0 AND status IN ('completed', 'failed') ORDER BY id",
+                (job_id,)
+            ).fetchall()
+            db.executemany("UPDATE work_items SET reported = 1 WHERE id = ?", [(r[0],) for r in rows])
+            db.execute("COMMIT")
+        return [(json.loads(payload), json.loads(result)) for _, payload, result in rows]
+
+
+def run_brokered(tracks: list, output_path: Path, browser: str, engine: str = "auto"):
+    """Enqueue every track for remote workers and fold their results back in.
+
+    Transient failures go through the same deferred retry schedule as local
+    jobs; due retries are enqueued again with the alternate query.
+    """
+    broker = SQLiteBroker(BROKER_DB)
+    job_id = download_status["job_id"]
+    base = {"output_dir": get_storage(str(output_path)).spec, "browser": browser, "engine": engine, "job_id": job_id}
+    broker.enqueue(job_id, [{**base, "track": track_info} for track_info in tracks])
+    add_log(f"📨 Queued {len(tracks)} tracks for workers", "info")
+    
+    retry_queue = []
+    outstanding = len(tracks)
+    while outstanding or retry_queue:
+        for payload, result in broker.collect(job_id):
+            outstanding -= 1
+            track_info = payload["track"]
+            download_status["current_track"] = track_info["track"]
+            download_status["current_artist"] = track_info["artist"]
+            for entry in result.get("log", []):
+                add_log(entry["message"], entry["type"])
+            result.setdefault("query", f"{track_info['artist']} - {track_info['track']}")
+            if result["status"] == "failed" and is_transient(result.get("error_class", "")):
+                with status_lock:
+                    schedule_retry(retry_queue, track_info, payload.get("attempt", 0) + 1, result)
+            else:
+                record_result(track_info, result)
+            download_status["progress"] = download_status["completed_count"] + download_status["failed_count"]
+        
+        now = time.time()
+        due = [item for item in retry_queue if item["due"] <= now]
+        if due:
+            retry_queue[:] = [item for item in retry_queue if item["due"] > now]
+            payloads = []
+            for item in due:
+                queries = retry_queries(item["track"])
+                payloads.append({**base, "track": item["track"], "attempt": item["attempt"],
+                                 "query": queries[item["attempt"] % len(queries)]})
+            broker.enqueue(job_id, payloads)
+            outstanding += len(payloads)
+        download_status["retry_pending"] = len(retry_queue)
+        time.sleep(1.0)
+
+
+def run_worker(broker_path: str):
+    """Worker process loop: lease tracks from the broker and download them."""
+    broker = SQLiteBroker(broker_path)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Worker {worker} polling {broker_path}")
+    last_job = ""
+    
+    while True:
+        item = broker.lease(worker)
+        if item is None:
+            time.sleep(2.0)
+            continue
+        item_id, payload = item
+        
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(LEASE_SECONDS / 3):
+                if not broker.heartbeat(item_id, worker):
+                    return
+        threading.Thread(target=heartbeat, daemon=True).start()
+        
+        download_status["log"] = []
+        try:
+            storage = get_storage(payload["output_dir"])
+            if payload["job_id"] != last_job:
+                storage.refresh()
+                last_job = payload["job_id"]
+            output_path = storage.local_dir
+            result = process_track(
+                payload["track"], output_path, payload["browser"], payload["job_id"],
+                payload.get("query", ""), payload.get("engine", "auto")
+            )
+        except Exception as e:
+            error = clean_error_message(str(e))
+            result = {
+                "status": "failed", "note": "", "error": error[:50],
+                "error_class": classify_error(error), "downloaded": False
+            }
+        finally:
+            stop.set()
+        result["log"] = download_status["log"]
+        broker.complete(item_id, worker, result)
+        print(f"[{result['status']}] {payload['track']['artist']} - {payload['track']['track']}")
+        
+        if result["downloaded"]:
+            time.sleep(random.uniform(1.0, 2.0))
+
+
+# ============== STORAGE BACKENDS ==============
+
+class LocalStorage:
+    """Finished files stay in the local output directory."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        self.local_dir = Path(spec)
+
+    def exists(self, name: str) -> bool:
+        return (self.local_dir / name).exists()
+
+    def put(self, local_file: Path, name: str):
+        pass
+
+    def refresh(self):
+        pass
+
+    def describe(self) -> str:
+        return str(self.local_dir.absolute())
+
+
+class S3Storage:
+    """S3-compatible bucket; files are staged in local_dir and uploaded when finished.
+
+    The bucket listing under the prefix is fetched once per job and cached,
+    so existence checks cost no requests. Files bound for the bucket are not
+    kept in the local library store.
+    """
+
+    def __init__(self, spec: str):
+        if boto3 is None:
+            raise ValueError("s3:// output needs boto3 (pip install boto3)")
+        bucket, _, prefix = spec[len("s3://"):].partition("/")
+        self.spec = spec
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=S3_ENDPOINT)
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_PART_SIZE,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_UPLOAD_CONCURRENCY,
+        )
+        self.local_dir = Path(tempfile.gettempdir()) / "spotidown-s3" / bucket / self.prefix
+        self._listing = None
+        self._lock = threading.Lock()
+
+    def _keys(self) -> set:
+        with self._lock:
+            if self._listing is None:
+                listing = set()
+                paginator = self.client.get_paginator("list_objects_v2")
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                    listing.update(obj["Key"] for obj in page.get("Contents", []))
+                self._listing = listing
+            return self._listing
+
+    def exists(self, name: str) -> bool:
+        return self.prefix + name in self._keys()
+
+    def refresh(self):
+        """Drop the cached listing so the next check sees the bucket as it is now."""
+        with self._lock:
+            self._listing = None
+
+    def put(self, local_file: Path, name: str):
+        key = self.prefix + name
+        self.client.upload_file(str(local_file), self.bucket, key, Config=self.transfer)
+        with self._lock:
+            if self._listing is not None:
+                self._listing.add(key)
+        local_file.unlink()
+
+    def describe(self) -> str:
+        endpoint = f" via {S3_ENDPOINT}" if S3_ENDPOINT else ""
+        return f"{self.spec}{endpoint}"
+
+
+def get_storage(output_dir: str):
+    """Return the (cached) storage backend for an output_dir spec."""
+    with storage_lock:
+        storage = storage_backends.get(output_dir)
+        if storage is None:
+            if output_dir.startswith("s3://"):
+                storage = S3Storage(output_dir)
+            else:
+                storage = LocalStorage(output_dir)
+            storage.local_dir.mkdir(parents=True, exist_ok=True)
+            storage_backends[output_dir] = storage
+            storage_backends[str(storage.local_dir)] = storage
+        return storage
+
+
+# ============== SCRATCH SPACE ==============
+
+def clean_scratch():
+    """Delete scratch dirs left behind by processes that are no longer running."""
+    if not SCRATCH_DIR or not os.path.isdir(SCRATCH_DIR):
+        return
+    for entry in os.scandir(SCRATCH_DIR):
+        pid = entry.name.split(".", 1)[0]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue  # alive, owned by another user
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.unlink(entry.path)
+
+
+def disk_preflight(tracks: list, output_path: Path):
+    """Fail the job early when scratch or output space cannot hold it.
+
+    Object storage only stages one file per track locally, so only scratch
+    space is checked for it.
+    """
+    if not isinstance(get_storage(str(output_path)), LocalStorage):
+        tracks = []
+    # Files already present or hardlinkable from the library cost no new space;
+    # library hits that need their own tags are full copies
+    pending = [
+        t for t in tracks
+        if not (output_path / f"{sanitize_filename(t['artist'] + ' - ' + t['track'])}.mp3").exists()
+        and not library_lookup_track(recording_keys(t))[1]
+    ]
+    needed = sum((t.get("duration_ms") or 240000) / 1000 * TARGET_BITRATE * 1000 / 8 for t in pending)
+    free = shutil.disk_usage(output_path).free
+    if free < needed:
+        raise OSError(f"Not enough space in {output_path}: {needed / 1e6:.0f} MB needed, {free / 1e6:.0f} MB free")
+    if SCRATCH_DIR:
+        Path(SCRATCH_DIR).mkdir(parents=True, exist_ok=True)
+        free = shutil.disk_usage(SCRATCH_DIR).free
+        if free < SCRATCH_MIN_FREE:
+            raise OSError(f"Not enough scratch space in {SCRATCH_DIR}: {free / 1e6:.0f} MB free")
+
+
+def move_into_place(src: Path, dst: Path):
+    """Publish a finished file with one atomic rename, copying first across filesystems."""
+    try:
+        os.replace(src, dst)
+        return
+    except OSError:
+        pass
+    tmp_file = dst.with_name(f".{dst.name}.{os.getpid()}.part")
+    try:
+        shutil.copyfile(src, tmp_file)
+        os.replace(tmp_file, dst)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    src.unlink()
+
+
+# ============== TAGGING ==============
+
+def artwork_for(track_info: dict):
+    """Album cover bytes from the shared cache, fetching it on a miss."""
+    album_id = track_info.get("album_id")
+    url = track_info.get("artwork_url")
+    if not album_id or not url:
+        return None
+    path = ARTWORK_DIR / f"{album_id}.jpg"
+    if path.exists():
+        os.utime(path)  # mtime is the LRU clock
+        return path.read_bytes()
+    response = requests.get(url, timeout=15)
+    response.raise_for_status()
+    ARTWORK_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_bytes(response.content)
+    os.replace(tmp_file, path)
+    _evict_artwork()
+    return response.content
+
+
+def _evict_artwork():
+    files = []
+    for entry in os.scandir(ARTWORK_DIR):
+        if entry.name.endswith(".jpg"):
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= ARTWORK_CACHE_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def tag_file(path: Path, track_info: dict):
+    """Write title/artist/album/number/ISRC/Spotify ID tags and cover art."""
+    try:
+        tags = ID3(str(path))
+    except ID3NoHeaderError:
+        tags = ID3()
+    tags.setall("TIT2", [TIT2(encoding=3, text=track_info["track"])])
+    tags.setall("TPE1", [TPE1(encoding=3, text=track_info.get("artists") or [track_info["artist"]])])
+    if track_info.get("album"):
+        tags.setall("TALB", [TALB(encoding=3, text=track_info["album"])])
+    if track_info.get("track_number"):
+        tags.setall("TRCK", [TRCK(encoding=3, text=str(track_info["track_number"]))])
+    if track_info.get("disc_number"):
+        tags.setall("TPOS", [TPOS(encoding=3, text=str(track_info["disc_number"]))])
+    if track_info.get("isrc"):
+        tags.setall("TSRC", [TSRC(encoding=3, text=track_info["isrc"])])
+    if track_info.get("id"):
+        tags.add(TXXX(encoding=3, desc="SPOTIFY_ID", text=track_info["id"]))
+    try:
+        cover = artwork_for(track_info)
+    except Exception as e:
+        cover = None
+        add_log(f"Warning: no cover art for {track_info['track']}: {clean_error_message(str(e))[:50]}", "info")
+    if cover:
+        tags.setall("APIC", [APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover)])
+    tags.save(str(path), v2_version=3)
+
+
+def tagging_enabled() -> bool:
+    return TAGGING and ID3 is not None
+
+
+def _finalize(path: Path, track_info: dict, keys: list, storage, claim):
+    try:
+        if tagging_enabled():
+            try:
+                tag_file(path, track_info)
+            except Exception as e:
+                add_log(f"Warning: could not tag {path.name}: {clean_error_message(str(e))[:50]}", "info")
+        # Object storage keeps no local copy, so only local outputs join the library
+        if isinstance(storage, LocalStorage):
+            stored = library_ingest(path, keys)
+            if FINGERPRINTS and not tagging_enabled() and shutil.which("fpcalc"):
+                fingerprint_dedup(path, stored, keys)
+        storage.put(path, path.name)
+    finally:
+        if claim is not None:
+            release_recording(keys, claim)
+
+
+def _finalize_done():
+    global finalize_pending
+    with finalize_cond:
+        finalize_pending -= 1
+        finalize_cond.notify_all()
+
+
+def _finalize_task(*args, **kwargs):
+    try:
+        _finalize(*args, **kwargs)
+    except Exception as e:
+        add_log(f"Error finishing {args[0].name}: {clean_error_message(str(e))[:50]}", "error")
+    finally:
+        _finalize_done()
+
+
+def finalize_track(path: Path, track_info: dict, keys: list, storage, claim):
+    """Tag, store and publish a downloaded file, off the download thread when tagging.
+
+    Runs in a pool as wide as MAX_CONCURRENCY so finalisation keeps up with
+    parallel downloads. The in-flight claim is released only once the file
+    is in the library, so parallel duplicates link to it instead of
+    downloading again.
+    """
+    global finalize_pool, finalize_pending
+    if not tagging_enabled():
+        _finalize(path, track_info, keys, storage, claim)
+        return
+    with finalize_cond:
+        if finalize_pool is None:
+            finalize_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="finalize")
+        finalize_pending += 1
+    finalize_pool.submit(_finalize_task, path, track_info, keys, storage, claim)
+
+
+def wait_for_finalize():
+    """Block until every queued finalisation (tags, library, upload, fingerprint) is done."""
+    with finalize_cond:
+        while finalize_pending:
+            finalize_cond.wait()
+
+
+# ============== FINGERPRINTS ==============
+
+def fingerprint_file(path: str) -> dict:
+    """Chromaprint raw fingerprint via fpcalc (runs in a worker process)."""
+    proc = subprocess.run(["fpcalc", "-raw", "-json", path], capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip()[:200] or "fpcalc failed")
+    data = json.loads(proc.stdout)
+    return {"duration": data["duration"], "fp": data["fingerprint"]}
+
+
+def fingerprint_similarity(a: list, b: list) -> float:
+    """Best fraction of equal bits between two raw fingerprints over small shifts."""
+    best = 0.0
+    for offset in range(-FINGERPRINT_MAX_OFFSET, FINGERPRINT_MAX_OFFSET + 1):
+        pairs = list(zip(a[max(offset, 0):], b[max(-offset, 0):]))
+        if not pairs:
+            continue
+        errors = sum(bin((x ^ y) & 0xFFFFFFFF).count("1") for x, y in pairs)
+        best = max(best, 1 - errors / (32 * len(pairs)))
+    return best
+
+
+def _fingerprint_db_path() -> str:
+    return str(LIBRARY_DIR / "fingerprints.db")
+
+
+def _fingerprint_connect():
+    """Connection to the fingerprint index (SQLite, WAL), creating it on first use."""
+    global fingerprint_ready
+    with fingerprint_lock:
+        if not fingerprint_ready:
+            LIBRARY_DIR.mkdir(parents=True, exist_ok=True)
+            with closing(sqlite3.connect(_fingerprint_db_path(), timeout=30, isolation_level=None)) as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS fingerprints (
+                        digest TEXT PRIMARY KEY,
+                        duration REAL NOT NULL,
+                        fp BLOB NOT NULL
+                    )
+                """)
+                db.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_duration ON fingerprints (duration)")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS duplicates (
+                        keep TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        keys TEXT NOT NULL,
+                        similarity REAL NOT NULL,
+                        bytes_saved INTEGER NOT NULL,
+                        merged REAL NOT NULL
+                    )
+                """)
+                db.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_keep ON duplicates (keep)")
+            fingerprint_ready = True
+    return sqlite3.connect(_fingerprint_db_path(), timeout=30, isolation_level=None)
+
+
+def fingerprint_match(path: str, db_path: str, digest: str) -> dict:
+    """Fingerprint a file and find its closest stored match (runs in a worker process).
+
+    Only fingerprints of similar duration are compared, so the bit comparison
+    stays small and happens outside the server process.
+    """
+    fingerprint = fingerprint_file(path)
+    with closing(sqlite3.connect(db_path, timeout=30)) as db:
+        rows = db.execute(
+            "SELECT digest, fp FROM fingerprints WHERE duration BETWEEN ? AND ? AND digest != ?",
+            (fingerprint["duration"] - FINGERPRINT_DURATION_SLACK,
+             fingerprint["duration"] + FINGERPRINT_DURATION_SLACK, digest)
+        ).fetchall()
+    match, similarity = None, 0.0
+    for other, blob in rows:
+        stored = array("I")
+        stored.frombytes(blob)
+        score = fingerprint_similarity(fingerprint["fp"], stored)
+        if score >= FINGERPRINT_MATCH and score > similarity:
+            match, similarity = other, score
+    return {**fingerprint, "match": match, "similarity": similarity}
+
+
+def fingerprint_dedup(path: Path, stored: Path, keys: list):
+    """Queue a newly stored object for fingerprinting; near-duplicates are collapsed when it finishes.
+
+    The pending fingerprint counts towards wait_for_finalize(), so a job only
+    ends once its merges are done.
+    """
+    global fingerprint_pool, finalize_pending
+    digest = stored.stem
+    with closing(_fingerprint_connect()) as db:
+        if db.execute("SELECT 1 FROM fingerprints WHERE digest = ?", (digest,)).fetchone():
+            return
+    with fingerprint_lock:
+        if fingerprint_pool is None:
+            fingerprint_pool = ProcessPoolExecutor(max_workers=VERIFY_CONCURRENCY)
+    size = stored.stat().st_size
+    with finalize_cond:
+        finalize_pending += 1
+    try:
+        future = fingerprint_pool.submit(fingerprint_match, str(stored), _fingerprint_db_path(), digest)
+    except Exception:
+        _finalize_done()
+        raise
+    future.add_done_callback(lambda done: _fingerprint_done(done, path, digest, keys, size))
+
+
+def _fingerprint_done(future, path: Path, digest: str, keys: list, size: int):
+    try:
+        _fingerprint_merge(future, path, digest, keys, size)
+    finally:
+        _finalize_done()
+
+
+def _fingerprint_merge(future, path: Path, digest: str, keys: list, size: int):
+    try:
+        found = future.result()
+    except Exception as e:
+        add_log(f"Warning: could not fingerprint {path.name}: {clean_error_message(str(e))[:50]}", "info")
+        return
+    try:
+        blob = array("I", [value & 0xFFFFFFFF for value in found["fp"]]).tobytes()
+        method = library_merge(path, keys, digest, found["match"]) if found["match"] else None
+        with closing(_fingerprint_connect()) as db:
+            if method is None:
+                if found["match"]:
+                    # The matching object was garbage-collected; keep this one instead
+                    db.execute("DELETE FROM fingerprints WHERE digest = ?", (found["match"],))
+                db.execute(
+                    "INSERT OR REPLACE INTO fingerprints (digest, duration, fp) VALUES (?, ?, ?)",
+                    (digest, found["duration"], blob)
+                )
+                return
+            db.execute(
+                "INSERT INTO duplicates (keep, path, keys, similarity, bytes_saved, merged) VALUES (?, ?, ?, ?, ?, ?)",
+                (found["match"], str(path.absolute()), json.dumps(keys), round(found["similarity"], 3),
+                 size, time.time())
+            )
+        add_log(f"🧬 {path.name} matches stored audio ({found['similarity']:.0%}), {method}", "info")
+    except Exception as e:
+        add_log(f"Warning: fingerprint dedup failed for {path.name}: {clean_error_message(str(e))[:50]}", "info")
+
+
+def duplicate_clusters() -> list:
+    """Stored objects that absorbed near-duplicate downloads, largest clusters first."""
+    clusters = {}
+    with closing(_fingerprint_connect()) as db:
+        for keep, path, keys, similarity, saved in db.execute(
+            "SELECT keep, path, keys, similarity, bytes_saved FROM duplicates ORDER BY merged"
+        ):
+            clusters.setdefault(keep, []).append({
+                "path": path, "keys": json.loads(keys), "similarity": similarity, "bytes_saved": saved,
+            })
+    result = []
+    with closing(_library_connect()) as db:
+        for digest, members in clusters.items():
+            row = db.execute("SELECT ext FROM objects WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                continue
+            refs = [ref for (ref,) in db.execute("SELECT path FROM refs WHERE digest = ?", (digest,))]
+            result.append({
+                "digest": digest,
+                "object": str(_object_path(digest, row[0])),
+                "refs": refs,
+                "duplicates": members,
+            })
+    result.sort(key=lambda c: len(c["duplicates"]), reverse=True)
+    return result
+
+
+def claim_recording(keys: list):
+    """Mark a recording as in flight. Returns the claim, or None after waiting
+    for another thread that was already downloading it."""
+    with inflight_lock:
+        busy = [inflight[key] for key in keys if key in inflight]
+        if not busy:
+            claim = threading.Event()
+            for key in keys:
+                inflight[key] = claim
+            return claim
+    busy[0].wait()
+    return None
+
+
+def release_recording(keys: list, claim):
+    with inflight_lock:
+        for key in keys:
+            if inflight.get(key) is claim:
+                del inflight[key]
+    claim.set()
+
+
+def process_track(track_info: dict, output_path: Path, browser: str, job_id: str = "",
+                  search_query: str = "", engine: str = "auto") -> dict:
+    """Skip, link or download one track into output_path and describe the outcome.
+
+    search_query overrides the YouTube search; the file is always named after
+    "artist - track".
+    """
+    artist = track_info["artist"]
+    track_name = track_info["track"]
+    file_query = f"{artist} - {track_name}"
+    search_query = search_query or file_query
+    result = {
+        "query": file_query, "status": "completed", "note": "",
+        "error": "", "error_class": "", "downloaded": False
+    }
+    
+    safe_name = sanitize_filename(file_query)
+    keys = recording_keys(track_info)
+    storage = get_storage(str(output_path))
+    
+    # Check if file already exists
+    expected_file = output_path / f"{safe_name}.mp3"
+    if expected_file.exists():
+        if keys and not library_lookup(keys):
+            library_ingest(expected_file, keys)
+        result["note"] = "already exists"
+        return result
+    if storage.exists(expected_file.name):
+        result["note"] = "already exists"
+        return result
+    
+    # Same recording already downloaded (this playlist or another one), or
+    # being downloaded right now by a parallel worker
+    stored, shared = library_lookup_track(keys)
+    claim = None
+    if not stored:
+        claim = claim_recording(keys)
+        if claim is None:
+            stored, shared = library_lookup_track(keys)
+    if stored:
+        result["note"] = f"duplicate, {library_link(stored, expected_file, private=not shared)}"
+        if shared:
+            storage.put(expected_file, expected_file.name)
+        else:
+            # Another track's object (same ISRC): retag the copy and store it
+            # under this track's keys so its next hit can be hardlinked
+            finalize_track(expected_file, track_info, keys, storage, None)
+        return result
+    
+    work_dir = Path(SCRATCH_DIR) / f"{os.getpid()}.{uuid.uuid4().hex[:8]}" if SCRATCH_DIR else output_path
+    output_template = str(work_dir / f"{safe_name}.%(ext)s")
+    try:
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # A manifest match from a resolve-only run skips the search, unless a
+        # retry asked for a different query
+        video_url = "" if search_query != file_query else track_info.get("video_url", "")
+        success, last_error, result["video_url"] = download_track(
+            search_query, output_template, browser, job_id, engine, video_url
+        )
+        result["downloaded"] = True
+        scratch_file = work_dir / expected_file.name
+        if success and work_dir != output_path and scratch_file.exists():
+            move_into_place(scratch_file, expected_file)
+        if success and expected_file.exists():
+            result["bytes"] = expected_file.stat().st_size
+            finalize_track(expected_file, track_info, keys, storage, claim)
+            claim = None
+    finally:
+        if claim is not None:
+            release_recording(keys, claim)
+        if work_dir != output_path:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if not success:
+        short_error = last_error[:50] + "..." if len(last_error) > 50 else last_error
+        result["status"] = "failed"
+        result["error"] = short_error.replace("ERROR:", "").strip()
+        result["error_class"] = classify_error(last_error)
+    return result
+
+
+def record_result(track_info: dict, result: dict):
+    """Fold a process_track() result into download_status and the log."""
+    with status_lock:
+        _record_result(track_info, result)
+
+
+def _record_result(track_info: dict, result: dict):
+    track_name = track_info["track"]
+    artist = track_info["artist"]
+    store = open_job_results(download_status["job_id"], create=True)
+    row = store.add({
+        "query": result["query"],
+        "track": track_name,
+        "artist": artist,
+        "spotify_id": track_info.get("id"),
+        "status": result["status"],
+        "note": result["note"],
+        "error": result["error"],
+        "error_class": result.get("error_class", ""),
+    })
+    if STATE_DB:
+        state_store().add_result(download_status["job_id"], row)
+    if HISTORY_DB:
+        history_store().add_track(download_status["job_id"], row, track_info, result)
+    if result["status"] == "completed":
+        download_status["completed_count"] += 1
+        note = f" ({result['note']})" if result["note"] else ""
+        add_log(f"{track_name} - {artist}{note}", "success")
+    else:
+        download_status["failed_count"] += 1
+        add_log(f"{track_name}: {result['error']}", "error")
+
+
+# ============== THROUGHPUT ==============
+
+class ThroughputEstimator:
+    """EWMA latency and bytes/sec per stage, used for the ETA.
+
+    Stages are "skip" (already on disk or linked from the library) and
+    "download" (searched and fetched from YouTube).
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, nbytes: int = 0):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {"count": 0, "latency": seconds, "rate": None})
+            stats["count"] += 1
+            stats["latency"] += self.alpha * (seconds - stats["latency"])
+            if nbytes and seconds > 0:
+                rate = nbytes / seconds
+                stats["rate"] = rate if stats["rate"] is None else stats["rate"] + self.alpha * (rate - stats["rate"])
+
+    def eta(self, remaining: int, concurrency: int):
+        """Seconds left for the remaining tracks, or None before any observation."""
+        with self.lock:
+            total = sum(stats["count"] for stats in self.stages.values())
+            if not total:
+                return None
+            per_track = sum(
+                stats["count"] / total * stats["latency"] for stats in self.stages.values()
+            )
+        return remaining * per_track / max(concurrency, 1)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                stage: {
+                    "count": stats["count"],
+                    "latency": round(stats["latency"], 2),
+                    "bytes_per_sec": round(stats["rate"]) if stats["rate"] else None,
+                }
+                for stage, stats in self.stages.items()
+            }
+
+
+class ConcurrencyController:
+    """Hill-climbs the number of parallel downloads on measured throughput.
+
+    Every window it compares completed tracks/sec with the previous window:
+    keep moving while throughput improves, reverse when it does not, and halve
+    when transient errors (429s, bot checks, stalls) pass ERROR_BACKOFF_RATE.
+    """
+
+    def __init__(self, initial: int, maximum: int, window: float = 30.0):
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.window = window
+        self.direction = 1
+        self.last_rate = None
+        self.window_start = time.monotonic()
+        self.done = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def observe(self, transient_error: bool):
+        """Record a finished track; returns a message when the limit changes."""
+        with self.lock:
+            self.done += 1
+            self.errors += transient_error
+            elapsed = time.monotonic() - self.window_start
+            if elapsed < self.window or self.done < self.limit * 2:
+                return None
+            rate = self.done / elapsed
+            previous = self.limit
+            if self.errors / self.done > ERROR_BACKOFF_RATE:
+                self.limit = max(1, self.limit // 2)
+                self.direction = 1
+                reason = "errors rising"
+            elif self.last_rate is None or rate > self.last_rate * 1.05:
+                self.limit = max(1, min(self.limit + self.direction, self.maximum))
+                reason = "throughput rising"
+            else:
+                self.direction = -self.direction
+                self.limit = max(1, min(self.limit + self.direction, self.maximum))
+                reason = "no throughput gain"
+            self.last_rate = rate
+            self.window_start = time.monotonic()
+            self.done = 0
+            self.errors = 0
+            if self.limit != previous:
+                return f"⚙ Parallel downloads {previous} → {self.limit} ({reason})"
+            return None
+
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def run_tracks(tracks: list, output_path: Path, browser: str, engine: str) -> list:
+    """Process tracks in parallel under the adaptive concurrency limit.
+
+    Returns the deferred retry queue.
+    """
+    estimator = ThroughputEstimator()
+    controller = ConcurrencyController(INITIAL_CONCURRENCY, MAX_CONCURRENCY)
+    retry_queue = []
+    state = {"active": 0, "finished": 0}
+    cond = threading.Condition()
+    
+    def work(track_info):
+        started = time.monotonic()
+        try:
+            result = process_track(
+                track_info, output_path, browser, download_status["job_id"], engine=engine
+            )
+        except Exception as e:
+            error = clean_error_message(str(e))
+            result = {
+                "query": f"{track_info['artist']} - {track_info['track']}", "status": "failed",
+                "note": "", "error": error[:50], "error_class": classify_error(error), "downloaded": False
+            }
+        elapsed = time.monotonic() - started
+        result["seconds"] = round(elapsed, 2)
+        estimator.observe("download" if result["downloaded"] else "skip", elapsed, result.get("bytes", 0))
+        
+        transient = result["status"] == "failed" and is_transient(result["error_class"])
+        if transient:
+            with status_lock:
+                schedule_retry(retry_queue, track_info, 1, result)
+        else:
+            record_result(track_info, result)
+        message = controller.observe(transient)
+        if message:
+            add_log(message, "info")
+        
+        # Delay between tracks
+        if result["downloaded"]:
+            time.sleep(random.uniform(1.0, 2.0))
+        
+        with cond:
+            state["active"] -= 1
+            state["finished"] += 1
+            remaining = len(tracks) - state["finished"]
+            eta = estimator.eta(remaining, controller.limit)
+            download_status["eta"] = format_eta(eta) if eta is not None and remaining else ""
+            download_status["concurrency"] = controller.limit
+            download_status["throughput"] = estimator.report()
+            cond.notify_all()
+    
+    for idx, track_info in enumerate(tracks, 1):
+        with cond:
+            while state["active"] >= controller.limit:
+                cond.wait(1.0)
+            state["active"] += 1
+        download_status["current_track"] = track_info["track"]
+        download_status["current_artist"] = track_info["artist"]
+        download_status["progress"] = idx
+        threading.Thread(target=work, args=(track_info,), daemon=True).start()
+    
+    with cond:
+        while state["active"]:
+            cond.wait(1.0)
+    return retry_queue
+
+
+# ============== RESOLVE MANIFEST ==============
+
+def manifest_key(track_info: dict) -> str:
+    if track_info.get("id"):
+        return f"spotify:{track_info['id']}"
+    return f"query:{track_info['artist']} - {track_info['track']}"
+
+
+def match_confidence(track_info: dict, entry: dict) -> float:
+    """0..1 score from duration agreement and how much of the name the title covers."""
+    score = 0.0
+    expected = (track_info.get("duration_ms") or 0) / 1000
+    if expected and entry.get("duration"):
+        score += 0.6 * max(0.0, 1 - abs(entry["duration"] - expected) / max(expected * 0.25, 5))
+    words = set(re.findall(r"\w+", f"{track_info['artist']} {track_info['track']}".lower()))
+    title = set(re.findall(r"\w+", f"{entry.get('title', '')} {entry.get('channel', '')}".lower()))
+    if words:
+        score += 0.4 * len(words & title) / len(words)
+    return round(score, 3)
+
+
+def estimate_size(entry: dict, fmt: dict = None) -> int:
+    """Approximate bytes of the stream select_audio_format() would download."""
+    fmt = fmt or pick_audio_format(entry.get("formats") or [])
+    if fmt is None:
+        return 0
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    rate = fmt.get("abr") or fmt.get("tbr")
+    if not size and rate and entry.get("duration"):
+        size = rate * 1000 / 8 * entry["duration"]
+    return int(size or 0)
+
+
+def resolve_track(track_info: dict, browser: str) -> dict:
+    """Metadata-only search for one track."""
+    query = f"{track_info['artist']} - {track_info['track']}"
+    ydl_opts = build_ydl_opts("%(id)s.%(ext)s")
+    if browser != "none":
+        ydl_opts["cookiesfrombrowser"] = (browser,)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(f"ytsearch1:{query}", download=False)
+    entries = [entry for entry in (info or {}).get("entries") or [] if entry]
+    if not entries:
+        raise ValueError("No video results")
+    entry = entries[0]
+    fmt = pick_audio_format(entry.get("formats") or []) or {}
+    return {
+        "query": query,
+        "video_id": entry.get("id"),
+        "url": entry.get("webpage_url") or f"https://www.youtube.com/watch?v={entry.get('id')}",
+        "title": entry.get("title", ""),
+        "duration": entry.get("duration"),
+        "confidence": match_confidence(track_info, entry),
+        "format_id": fmt.get("format_id"),
+        "acodec": fmt.get("acodec"),
+        "abr": fmt.get("abr"),
+        "est_bytes": estimate_size(entry, fmt),
+        "resolved_at": time.time(),
+    }
+
+
+def load_manifest(output_path: Path) -> dict:
+    manifest_file = output_path / MANIFEST_NAME
+    if not manifest_file.exists():
+        return {}
+    try:
+        return json.loads(manifest_file.read_text(encoding="utf-8")).get("tracks", {})
+    except ValueError:
+        return {}
+
+
+def save_manifest(output_path: Path, entries: dict):
+    manifest_file = output_path / MANIFEST_NAME
+    tmp_file = manifest_file.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps({"updated": time.time(), "tracks": entries}, indent=1), encoding="utf-8")
+    os.replace(tmp_file, manifest_file)
+
+
+def run_resolve(tracks: list, output_path: Path, browser: str):
+    """Resolve every track at RESOLVE_CONCURRENCY without downloading media."""
+    entries = load_manifest(output_path)
+    add_log(f"🔎 Resolving {len(tracks)} tracks (no download)", "info")
+    with ThreadPoolExecutor(max_workers=RESOLVE_CONCURRENCY) as pool:
+        futures = {pool.submit(resolve_track, track_info, browser): track_info for track_info in tracks}
+        for done, future in enumerate(as_completed(futures), 1):
+            track_info = futures[future]
+            download_status["progress"] = done
+            download_status["current_track"] = track_info["track"]
+            download_status["current_artist"] = track_info["artist"]
+            query = f"{track_info['artist']} - {track_info['track']}"
+            try:
+                match = future.result()
+            except Exception as e:
+                error = clean_error_message(str(e))
+                record_result(track_info, {
+                    "query": query, "status": "failed", "note": "",
+                    "error": error[:50], "error_class": classify_error(error)
+                })
+                continue
+            entries[manifest_key(track_info)] = match
+            record_result(track_info, {
+                "query": query, "status": "completed", "error": "", "error_class": "",
+                "note": f"→ {match['title']} ({match['confidence']:.0%}, ~{match['est_bytes'] / 1048576:.1f} MB)"
+            })
+    
+    save_manifest(output_path, entries)
+    planned = [entries[manifest_key(t)] for t in tracks if manifest_key(t) in entries]
+    total_mb = sum(match["est_bytes"] for match in planned) / 1048576
+    add_log(f"🗺 Manifest saved: {len(planned)} matches, ~{total_mb:.0f} MB to download", "info")
+
+
+def apply_manifest(tracks: list, output_path: Path):
+    """Attach confident manifest matches to tracks so they skip the search."""
+    entries = load_manifest(output_path)
+    used = 0
+    for track_info in tracks:
+        match = entries.get(manifest_key(track_info))
+        if match and match.get("confidence", 0) >= MIN_MANIFEST_CONFIDENCE:
+            track_info["video_url"] = match["url"]
+            used += 1
+    if used:
+        add_log(f"🗺 Using resolved matches for {used} of {len(tracks)} tracks", "info")
+
+
+def retry_queries(track_info: dict) -> list:
+    """Search queries to use on successive retries of a track."""
+    artist = track_info["artist"]
+    track_name = track_info["track"]
+    return [
+        f"{artist} - {track_name}",
+        f"{artist} {track_name} official audio",
+        f"{track_name} {artist} audio",
+    ]
+
+
+def schedule_retry(retry_queue: list, track_info: dict, attempt: int, result: dict):
+    """Queue a transiently failed track, or record it as failed once out of attempts."""
+    if attempt > RETRY_ATTEMPTS:
+        record_result(track_info, result)
+        return
+    delay = RETRY_BASE_DELAY * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+    retry_queue.append({"due": time.time() + delay, "attempt": attempt, "track": track_info})
+    download_status["retry_pending"] = len(retry_queue)
+    add_log(f"↻ {track_info['track']}: {result['error_class']}, retrying in {delay:.0f}s", "info")
+
+
+def run_retry_pass(retry_queue: list, output_path: Path, browser: str):
+    """Drain the deferred retry queue in due order with exponential backoff."""
+    while retry_queue:
+        retry_queue.sort(key=lambda item: item["due"])
+        item = retry_queue.pop(0)
+        download_status["retry_pending"] = len(retry_queue) + 1
+        time.sleep(max(item["due"] - time.time(), 0))
+        
+        track_info = item["track"]
+        queries = retry_queries(track_info)
+        query = queries[item["attempt"] % len(queries)]
+        download_status["current_track"] = track_info["track"]
+        download_status["current_artist"] = track_info["artist"]
+        
+        result = process_track(
+            track_info, output_path, browser, download_status["job_id"], query,
+            download_status["engine"]
+        )
+        if result["status"] == "failed" and is_transient(result["error_class"]):
+            schedule_retry(retry_queue, track_info, item["attempt"] + 1, result)
+        else:
+            record_result(track_info, result)
+    download_status["retry_pending"] = 0
+
+
+# ============== VERIFICATION ==============
+
+def probe_file(path: str) -> dict:
+    """Check that an audio file decodes and report its duration (runs in a worker process).
+
+    Uses ffprobe when available, otherwise only checks for an MP3/ID3 header.
+    """
+    if shutil.which("ffprobe"):
+        proc = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", path],
+            capture_output=True, text=True, timeout=60
+        )
+        if proc.returncode != 0 or proc.stderr.strip():
+            return {"ok": False, "duration": None, "error": (proc.stderr.strip() or "unreadable")[:200]}
+        try:
+            return {"ok": True, "duration": float(proc.stdout.strip()), "error": ""}
+        except ValueError:
+            return {"ok": False, "duration": None, "error": "no duration"}
+    with open(path, "rb") as f:
+        head = f.read(3)
+    if head == b"ID3" or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return {"ok": True, "duration": None, "error": ""}
+    return {"ok": False, "duration": None, "error": "no MP3 header"}
+
+
+def verify_existing(tracks: list, output_path: Path):
+    """Probe already-present files in parallel and delete corrupt ones.
+
+    A file is corrupt when it does not decode or is much shorter than the
+    Spotify duration; deleting it makes process_track() download it again.
+    """
+    index_file = output_path / VERIFY_INDEX_NAME
+    try:
+        index = json.loads(index_file.read_text(encoding="utf-8")) if index_file.exists() else {}
+    except ValueError:
+        index = {}
+    
+    candidates = []
+    for track_info in tracks:
+        path = output_path / f"{sanitize_filename(track_info['artist'] + ' - ' + track_info['track'])}.mp3"
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        candidates.append((track_info, path, st.st_size, st.st_mtime))
+    if not candidates:
+        return
     
-    download_status = {
+    pending = [c for c in candidates
+               if (index.get(c[1].name) or {}).get("stamp") != [c[2], c[3]]]
+    if pending:
+        add_log(f"🔎 Verifying {len(pending)} existing files...", "info")
+        with ProcessPoolExecutor(max_workers=min(VERIFY_CONCURRENCY, len(pending))) as pool:
+            futures = {pool.submit(probe_file, str(c[1])): c for c in pending}
+            for future in as_completed(futures):
+                _, path, size, mtime = futures[future]
+                try:
+                    probe = future.result()
+                except Exception as e:
+                    probe = {"ok": False, "duration": None, "error": str(e)[:200]}
+                index[path.name] = {"stamp": [size, mtime], **probe}
+    
+    corrupt = 0
+    for track_info, path, size, mtime in candidates:
+        entry = index[path.name]
+        expected = (track_info.get("duration_ms") or 0) / 1000
+        short = entry["duration"] is not None and expected and entry["duration"] < expected * MIN_DURATION_RATIO
+        if entry["ok"] and not short:
+            continue
+        reason = entry["error"] or f"{entry['duration']:.0f}s of {expected:.0f}s"
+        add_log(f"Corrupt file, re-downloading: {path.name} ({reason})", "error")
+        library_discard(path, recording_keys(track_info))
+        path.unlink()
+        del index[path.name]
+        corrupt += 1
+    
+    tmp_file = index_file.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(index), encoding="utf-8")
+    os.replace(tmp_file, index_file)
+    if corrupt:
+        add_log(f"🔎 {corrupt} of {len(candidates)} existing files were corrupt", "info")
+
+
+# ============== SPOTIFY LISTING ==============
+
+def track_entry(track: dict) -> dict:
+    artists = track.get("artists", [])
+    album = track.get("album") or {}
+    return {
+        "artist": artists[0]["name"] if artists else "Unknown Artist",
+        "artists": [a["name"] for a in artists],
+        "track": track.get("name", "Unknown"),
+        "id": track.get("id"),
+        "isrc": (track.get("external_ids") or {}).get("isrc"),
+        "duration_ms": track.get("duration_ms"),
+        "album": album.get("name"),
+        "album_id": album.get("id"),
+        "artwork_url": (album.get("images") or [{}])[0].get("url"),
+        "track_number": track.get("track_number"),
+        "disc_number": track.get("disc_number"),
+    }
+
+
+def list_playlist(sp, playlist_id: str) -> list:
+    tracks = []
+    offset = 0
+    while True:
+        results = sp.playlist_tracks(
+            playlist_id,
+            offset=offset,
+            limit=100,
+            fields="items(track(id,name,duration_ms,track_number,disc_number,external_ids(isrc),"
+                   "artists(name),album(id,name,images))),next"
+        )
+        for item in results.get("items", []):
+            track = item.get("track")
+            if track:
+                tracks.append(track_entry(track))
+        if not results.get("next"):
+            break
+        offset += 100
+    return tracks
+
+
+def fetch_tracks(sp, track_ids: list) -> dict:
+    """Full track objects via the batch endpoint, 50 IDs per request."""
+    found = {}
+    for start in range(0, len(track_ids), 50):
+        for track in sp.tracks(track_ids[start:start + 50]).get("tracks", []):
+            if track:
+                found[track["id"]] = track
+    return found
+
+
+def list_sources(sp, urls: list):
+    """List every track behind a mix of playlist, album, track and artist URLs.
+
+    Albums are fetched 20 per request and their tracks (for ISRCs) 50 per
+    request, so large imports cost a handful of calls. Returns
+    (display name, image URL, tracks) with tracks de-duplicated by ID.
+    """
+    wanted = {"playlist": [], "album": [], "track": [], "artist": []}
+    for url in urls:
+        kind, item_id = parse_spotify_url(url)
+        if item_id not in wanted[kind]:
+            wanted[kind].append(item_id)
+    
+    names = []
+    image = ""
+    ordered_ids = []     # track IDs in listing order, resolved in one batch
+    tracks_by_id = {}
+    listed = []
+    
+    for playlist_id in wanted["playlist"]:
+        info = sp.playlist(playlist_id, fields="name,images")
+        names.append(info.get("name", "Unknown"))
+        image = image or ((info.get("images") or [{}])[0].get("url", ""))
+        listed.extend(list_playlist(sp, playlist_id))
+    
+    for start in range(0, len(wanted["album"]), 20):
+        for album in sp.albums(wanted["album"][start:start + 20]).get("albums", []):
+            if not album:
+                continue
+            names.append(album.get("name", "Unknown"))
+            image = image or ((album.get("images") or [{}])[0].get("url", ""))
+            page = album.get("tracks") or {}
+            items = list(page.get("items", []))
+            while page.get("next"):
+                page = sp.next(page)
+                items.extend(page.get("items", []))
+            ordered_ids.extend(item["id"] for item in items if item and item.get("id"))
+    
+    ordered_ids.extend(wanted["track"])
+    if wanted["track"]:
+        names.append(f"{len(wanted['track'])} tracks")
+    
+    tracks_by_id.update(fetch_tracks(sp, [i for i in dict.fromkeys(ordered_ids)]))
+    listed.extend(track_entry(tracks_by_id[i]) for i in ordered_ids if i in tracks_by_id)
+    
+    for artist_id in wanted["artist"]:
+        top = sp.artist_top_tracks(artist_id).get("tracks", [])
+        if top:
+            names.append(f"{top[0]['artists'][0]['name']} top tracks")
+        listed.extend(track_entry(track) for track in top)
+    
+    tracks = []
+    seen = set()
+    for track_info in listed:
+        key = track_info["id"] or f"{track_info['artist']} - {track_info['track']}"
+        if key not in seen:
+            seen.add(key)
+            tracks.append(track_info)
+    
+    name = names[0] if len(names) == 1 else f"{len(urls)} sources"
+    return name, image, tracks
+
+
+def new_job_status(job_id: str = "", engine: str = "auto") -> dict:
+    return {
+        "job_id": job_id or uuid.uuid4().hex[:12],
         "running": True,
         "current_track": "",
         "current_artist": "",
         "progress": 0,
         "total": 0,
-        "completed": [],
-        "failed": [],
-        "log": [],
+        "completed_count": 0,
+        "failed_count": 0,
+        "retry_pending": 0,
+        "engine": engine,
+        "concurrency": INITIAL_CONCURRENCY,
         "playlist_name": "",
         "playlist_image": "",
-        "eta": ""
+        "eta": "",
+        "job_error": ""
     }
+
+
+def download_worker(client_id: str, client_secret: str, playlist_url: str, output_dir: str, browser: str,
+                    engine: str = "auto", mode: str = "download", job_id: str = ""):
+    global download_status
+    
+    download_status = new_job_status(job_id, engine)
+    download_status["mode"] = mode
+    open_job_log(download_status["job_id"], create=True)
+    open_job_results(download_status["job_id"], create=True)
+    reset_client_stats()
     
     try:
         add_log("🔐 Connecting to Spotify...", "info")
-        auth_manager = SpotifyClientCredentials(
-            client_id=client_id,
-            client_secret=client_secret
-        )
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        
-        playlist_id = extract_playlist_id(playlist_url)
+        sp = get_spotify_client(client_id, client_secret)
         
-        # Get playlist info with image
-        playlist_info = sp.playlist(playlist_id, fields="name,images,tracks(total)")
-        playlist_name = playlist_info.get("name", "Unknown")
-        total_tracks = playlist_info.get("tracks", {}).get("total", 0)
-        images = playlist_info.get("images", [])
+        urls = split_urls(playlist_url)
+        playlist_name, playlist_image, tracks = list_sources(sp, urls)
+        total_tracks = len(tracks)
         
         download_status["playlist_name"] = playlist_name
-        download_status["playlist_image"] = images[0]["url"] if images else ""
+        download_status["playlist_image"] = playlist_image
         download_status["total"] = total_tracks
         
         add_log(f"📋 Found: {playlist_name} ({total_tracks} tracks)", "info")
         
-        output_path = Path(output_dir)
-        output_path.mkdir(parents=True, exist_ok=True)
-        add_log(f"📁 Output: {output_path.absolute()}", "info")
+        storage = get_storage(output_dir)
+        storage.refresh()
+        output_path = storage.local_dir
+        add_log(f"📁 Output: {storage.describe()}", "info")
+        if HISTORY_DB:
+            history_store().start_job(download_status["job_id"], urls, playlist_name,
+                                      storage.describe(), mode, total_tracks)
         
         if browser != "none":
             add_log(f"🍪 Using {browser.title()} cookies for authentication...", "info")
         
-        # Fetch all tracks
-        tracks = []
-        offset = 0
-        while True:
-            results = sp.playlist_tracks(
-                playlist_id,
-                offset=offset,
-                limit=100,
-                fields="items(track(name,artists(name))),next"
-            )
-            for item in results.get("items", []):
-                track = item.get("track")
-                if track:
-                    artists = track.get("artists", [])
-                    artist = artists[0]["name"] if artists else "Unknown Artist"
-                    name = track.get("name", "Unknown")
-                    tracks.append({"artist": artist, "track": name})
-            if not results.get("next"):
-                break
-            offset += 100
+        if mode == "resolve":
+            run_resolve(tracks, output_path, browser)
+            completed = download_status['completed_count']
+            failed = download_status['failed_count']
+            add_log(f"🎉 Complete! {completed} resolved, {failed} failed", "info")
+            return
+        
+        apply_manifest(tracks, output_path)
+        verify_existing(tracks, output_path)
+        clean_scratch()
+        disk_preflight(tracks, output_path)
         
         # Download each track
-        for idx, track_info in enumerate(tracks, 1):
-            artist = track_info["artist"]
-            track_name = track_info["track"]
-            search_query = f"{artist} - {track_name}"
-            
-            download_status["current_track"] = track_name
-            download_status["current_artist"] = artist
-            download_status["progress"] = idx
-            
-            safe_name = sanitize_filename(search_query)
-            output_template = str(output_path / f"{safe_name}.%(ext)s")
-            
-            # Check if file already exists
-            expected_file = output_path / f"{safe_name}.mp3"
-            if expected_file.exists():
-                download_status["completed"].append(search_query)
-                add_log(f"{track_name} - {artist} (already exists)", "success")
-                continue
-            
-            # Enhanced yt-dlp options
-            ydl_opts = {
-                "default_search": "ytsearch1",
-                "format": "bestaudio/best",
-                "postprocessors": [{
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "192",
-                }],
-                "outtmpl": output_template,
-                "quiet": True,
-                "no_warnings": True,
-                "ignoreerrors": False,
-                "noplaylist": True,
-                "overwrites": False,
-                "http_headers": {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "Accept-Language": "en-us,en;q=0.5",
-                },
-                "retries": 3,
-                "fragment_retries": 3,
-                "socket_timeout": 30,
-                "extractor_args": {
-                    "youtube": {
-                        "player_client": ["android", "web"],
-                    }
-                },
-            }
-            
-            # Add browser cookies if selected
-            if browser != "none":
-                ydl_opts["cookiesfrombrowser"] = (browser,)
-            
-            success = False
-            last_error = ""
-            
-            # Try with selected browser, then fallback to no cookies
-            browsers_to_try = []
-            if browser != "none":
-                browsers_to_try.append(browser)
-            browsers_to_try.append(None)  # Last resort: no cookies
-            
-            for attempt_browser in browsers_to_try:
-                try:
-                    if attempt_browser:
-                        # Only set cookies if we have a browser
-                        ydl_opts["cookiesfrombrowser"] = (attempt_browser,)
-                        # Reduce timeout for cookie attempts
-                        ydl_opts["socket_timeout"] = 10
-                    else:
-                        ydl_opts.pop("cookiesfrombrowser", None)
-                        ydl_opts["socket_timeout"] = 30
-                    
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([f"ytsearch1:{search_query}"])
-                    
-                    download_status["completed"].append(search_query)
-                    add_log(f"{track_name} - {artist}", "success")
-                    success = True
-                    break
-                    
-                except Exception as e:
-                    last_error = clean_error_message(str(e))
-                    # Log the specific browser failure but don't stop unless all fail
-                    if attempt_browser:
-                        add_log(f"Warning: Failed to use {attempt_browser} cookies: {last_error[:50]}...", "info")
-                    continue
-            
-            if not success:
-                download_status["failed"].append(search_query)
-                short_error = last_error[:50] + "..." if len(last_error) > 50 else last_error
-                short_error = short_error.replace("ERROR:", "").strip()
-                add_log(f"{track_name}: {short_error}", "error")
-            
-            # Delay between tracks
-            time.sleep(random.uniform(1.0, 2.0))
+        if BROKER_DB:
+            run_brokered(tracks, output_path, browser, engine)
+        else:
+            retry_queue = run_tracks(tracks, output_path, browser, engine)
+            download_status["eta"] = ""
+            run_retry_pass(retry_queue, output_path, browser)
         
-        completed = len(download_status['completed'])
-        failed = len(download_status['failed'])
+        wait_for_finalize()
+        completed = download_status['completed_count']
+        failed = download_status['failed_count']
         add_log(f"🎉 Complete! {completed} downloaded, {failed} failed", "info")
         
     except Exception as e:
-        add_log(f"Error: {clean_error_message(str(e))}", "error")
+        # Whole-job failure (listing, auth, preflight); per-track failures are counted instead
+        download_status["job_error"] = clean_error_message(str(e))
+        add_log(f"Error: {download_status['job_error']}", "error")
     
     finally:
         download_status["running"] = False
+        if HISTORY_DB:
+            try:
+                history_store().finish_job(download_status["job_id"], download_status["completed_count"],
+                                           download_status["failed_count"])
+            except sqlite3.Error:
+                pass
+        job_log = job_logs.get(download_status["job_id"])
+        if job_log is not None:
+            job_log.close()
 
 
 # ============== FLASK ROUTES ==============
@@ -1486,31 +4794,42 @@ def index():
     return render_template_string(HTML_TEMPLATE, csrf_token=session['csrf_token'])
 
 
-@app.route("/start", methods=["POST"])
-def start_download():
+def launch_job(data: dict):
+    """Validate a job request and start it (or queue it in the state database)."""
     global download_status
     
-    if download_status.get("running"):
+    if STATE_DB and state_store().active() or download_status.get("running"):
         return jsonify({"error": "Download already in progress"})
     
-    # CSRF Protection
-    token = request.headers.get('X-CSRFToken')
-    if not token or token != session.get('csrf_token'):
-        return jsonify({"error": "Invalid CSRF token"}), 403
-    
-    data = request.json
     client_id = data.get("client_id", "").strip()
     client_secret = data.get("client_secret", "").strip()
     playlist_url = data.get("playlist_url", "").strip()
     output_dir = data.get("output_dir", "downloads").strip()
     browser = data.get("browser", "chrome").strip()
+    engine = data.get("engine", "auto").strip()
+    mode = data.get("mode", "download").strip()
     
     if not all([client_id, client_secret, playlist_url]):
         return jsonify({"error": "Missing required fields"})
     
+    try:
+        for url in split_urls(playlist_url):
+            parse_spotify_url(url)
+    except ValueError as e:
+        return jsonify({"error": str(e)})
+    
+    if STATE_DB:
+        state = new_job_status(engine=engine)
+        state["current_track"] = "Waiting for a runner..."
+        state_store().submit({
+            "client_id": client_id, "client_secret": client_secret, "playlist_url": playlist_url,
+            "output_dir": output_dir, "browser": browser, "engine": engine, "mode": mode
+        }, state)
+        return jsonify({"status": "queued", "job_id": state["job_id"]})
+    
     thread = threading.Thread(
         target=download_worker,
-        args=(client_id, client_secret, playlist_url, output_dir, browser)
+        args=(client_id, client_secret, playlist_url, output_dir, browser, engine, mode)
     )
     thread.daemon = True
     thread.start()
@@ -1518,14 +4837,350 @@ def start_download():
     return jsonify({"status": "started"})
 
 
+@app.route("/start", methods=["POST"])
+def start_download():
+    # CSRF Protection
+    token = request.headers.get('X-CSRFToken')
+    if not token or token != session.get('csrf_token'):
+        return jsonify({"error": "Invalid CSRF token"}), 403
+    
+    return launch_job(request.json or {})
+
+
+@app.route("/start/bulk", methods=["POST"])
+def start_bulk_download():
+    """Start one job for many URLs: JSON {"urls": [...]} or a multipart "file" upload."""
+    token = request.headers.get('X-CSRFToken')
+    if not token or token != session.get('csrf_token'):
+        return jsonify({"error": "Invalid CSRF token"}), 403
+    
+    if request.is_json:
+        data = dict(request.json or {})
+        urls = data.get("urls") or []
+    else:
+        data = request.form.to_dict()
+        upload = request.files.get("file")
+        urls = split_urls(upload.read().decode("utf-8", "replace")) if upload else []
+        urls += split_urls(data.get("urls", ""))
+    data["playlist_url"] = "\n".join(urls)
+    return launch_job(data)
+
+
+@app.route("/library/gc", methods=["POST"])
+def collect_library():
+    # Job runners in other processes ingest into the same library
+    if STATE_DB and state_store().active() or download_status.get("running"):
+        return jsonify({"error": "Download in progress"})
+    
+    token = request.headers.get('X-CSRFToken')
+    if not token or token != session.get('csrf_token'):
+        return jsonify({"error": "Invalid CSRF token"}), 403
+    
+    return jsonify(library_gc())
+
+
+@app.route("/library/duplicates")
+def get_duplicates():
+    clusters = duplicate_clusters()
+    return jsonify({"total": len(clusters), "clusters": clusters})
+
+
+@app.route("/bandwidth", methods=["GET", "POST"])
+def bandwidth_settings():
+    if request.method == "POST":
+        token = request.headers.get('X-CSRFToken')
+        if not token or token != session.get('csrf_token'):
+            return jsonify({"error": "Invalid CSRF token"}), 403
+        
+        data = request.json or {}
+        try:
+            bandwidth_configure(data.get("limit"), data.get("weights"))
+        except (TypeError, ValueError, AttributeError):
+            return jsonify({"error": "Invalid bandwidth settings"})
+        if STATE_DB:
+            # Runners pick the settings up on their next status publish
+            state_store().set_setting("bandwidth", {"limit": bandwidth["limit"], "weights": bandwidth["weights"]})
+    if STATE_DB:
+        latest = state_store().latest()
+        if latest and latest.get("bandwidth"):
+            return jsonify(latest["bandwidth"])
+    return jsonify(bandwidth_usage())
+
+
+def status_snapshot() -> dict:
+    status_copy = download_status.copy()
+    status_copy.pop("log", None)
+    status_copy["bandwidth"] = bandwidth_usage()
+    status_copy["clients"] = client_report()
+    return status_copy
+
+
 @app.route("/status")
 def get_status():
-    status_copy = download_status.copy()
-    download_status["log"] = []
+    # Each client passes the seq it has seen so concurrent pollers all get every entry
+    log_since = request.args.get("log_since", 0, type=int)
+    if STATE_DB:
+        status_copy = state_store().latest() or status_snapshot()
+        job_log = open_job_log(status_copy.get("job_id", ""))
+        status_copy["log"] = job_log.read(log_since, LOG_TAIL) if job_log else []
+        status_copy["log_next"] = log_since + len(status_copy["log"])
+        return jsonify(status_copy)
+    
+    status_copy = status_snapshot()
+    job_log = job_logs.get(download_status.get("job_id"))
+    status_copy["log"], status_copy["log_next"] = job_log.since(log_since) if job_log else ([], 0)
     return jsonify(status_copy)
 
 
+@app.route("/jobs/<job_id>/results")
+def get_job_results(job_id):
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    status = request.args.get("status", "")
+    error_class = request.args.get("error_class", "")
+    if STATE_DB:
+        total, rows, counts = state_store().query_results(job_id, status, error_class, offset, limit)
+    else:
+        store = open_job_results(job_id)
+        if store is None:
+            return jsonify({"error": "Unknown job"}), 404
+        total, rows = store.query(status, error_class, offset, limit)
+        counts = store.counts()
+    return jsonify({
+        "job_id": job_id,
+        "offset": offset,
+        "total": total,
+        "counts": counts,
+        "results": rows,
+    })
+
+
+@app.route("/history")
+def get_history():
+    if not HISTORY_DB:
+        return jsonify({"error": "History is disabled"}), 404
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    total, jobs = history_store().jobs(offset, limit)
+    return jsonify({"offset": offset, "total": total, "jobs": jobs})
+
+
+@app.route("/tracks")
+def get_tracks():
+    if not HISTORY_DB:
+        return jsonify({"error": "History is disabled"}), 404
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    since = request.args.get("since", 0, type=float)
+    filters = {name: request.args.get(name, "").strip() for name in HISTORY_FILTERS}
+    total, rows = history_store().tracks(filters, since, offset, limit)
+    return jsonify({"offset": offset, "total": total, "tracks": rows})
+
+
+@app.route("/jobs/<job_id>/log")
+def get_job_log(job_id):
+    job_log = open_job_log(job_id)
+    if job_log is None:
+        return jsonify({"error": "Unknown job"}), 404
+    offset = request.args.get("offset", 0, type=int)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    query = request.args.get("q", "")
+    return jsonify({
+        "job_id": job_id,
+        "offset": offset,
+        "total": job_log.total(),
+        "entries": job_log.read(offset, limit, query),
+    })
+
+
+# ============== LOAD TEST ==============
+
+LOADTEST_POLL_INTERVAL = 0.5   # the frontend's /status interval
+LOADTEST_START_EVERY = 20      # polls between /start attempts per client
+LOADTEST_TRACK_WORK = 2 * 1024 * 1024  # bytes hashed per synthetic track
+
+
+def _synthetic_job(stop: threading.Event, counter: list):
+    """Stand-in for download_worker: real status/log/result path, no network."""
+    global download_status
+    download_status = new_job_status()
+    download_status["playlist_name"] = "Load test"
+    open_job_log(download_status["job_id"], create=True)
+    open_job_results(download_status["job_id"], create=True)
+    block = os.urandom(64 * 1024)
+    while not stop.is_set():
+        n = counter[0] + 1
+        track_info = {"artist": f"Artist {n % 97}", "track": f"Track {n}", "id": f"synthetic{n}"}
+        download_status["current_track"] = track_info["track"]
+        download_status["current_artist"] = track_info["artist"]
+        download_status["progress"] = download_status["total"] = n
+        digest = hashlib.sha256()
+        for _ in range(LOADTEST_TRACK_WORK // len(block)):
+            digest.update(block)
+        failed = n % 10 == 0
+        record_result(track_info, {
+            "query": f"{track_info['artist']} - {track_info['track']}",
+            "status": "failed" if failed else "completed", "note": "",
+            "error": "HTTP Error 429: Too Many Requests" if failed else "",
+            "error_class": "rate_limited" if failed else "", "downloaded": True,
+        })
+        counter[0] = n
+    download_status["running"] = False
+
+
+def _loadtest_clients(base_url: str, clients: int, duration: float, results):
+    """Client process: `clients` dashboards polling /status, fetching / and trying /start."""
+    latencies = {"/": [], "/status": [], "/start": []}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    
+    def dashboard(seed: int):
+        http = requests.Session()
+        def timed(endpoint, call):
+            started = time.perf_counter()
+            response = None
+            try:
+                response = call()
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                latencies[endpoint].append(time.perf_counter() - started)
+                errors[0] += not ok
+            return response if ok else None
+        
+        page = timed("/", lambda: http.get(base_url + "/", timeout=30))
+        match = re.search(r'name="csrf-token" content="([0-9a-f]+)"', page.text) if page else None
+        token = match.group(1) if match else ""
+        log_next = 0
+        polls = seed
+        time.sleep(random.uniform(0, LOADTEST_POLL_INTERVAL))
+        while time.monotonic() < deadline:
+            tick = time.monotonic()
+            response = timed("/status", lambda: http.get(f"{base_url}/status?log_since={log_next}", timeout=30))
+            if response is not None:
+                log_next = response.json().get("log_next", log_next)
+            polls += 1
+            if polls % LOADTEST_START_EVERY == 0:
+                # A job is running, so this exercises validation without starting one
+                timed("/start", lambda: http.post(base_url + "/start", json={}, headers={"X-CSRFToken": token},
+                                                  timeout=30))
+            time.sleep(max(LOADTEST_POLL_INTERVAL - (time.monotonic() - tick), 0))
+    
+    threads = [threading.Thread(target=dashboard, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put({"latencies": latencies, "errors": errors[0]})
+
+
+def _percentiles(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+    return {"count": len(ordered), "p50_ms": round(pick(0.5), 1), "p95_ms": round(pick(0.95), 1),
+            "p99_ms": round(pick(0.99), 1), "max_ms": round(ordered[-1] * 1000, 1)}
+
+
+def run_loadtest(clients: int, duration: float = 30.0) -> dict:
+    """Measure endpoint latency, server CPU and worker slowdown under `clients` dashboards.
+
+    The synthetic job runs alone for `duration` seconds to get a baseline
+    track rate, then again while a separate client process polls the
+    in-process server.
+    """
+    from werkzeug.serving import make_server
+    global LOG_DIR, HISTORY_DB, STATE_DB
+    LOG_DIR = Path(tempfile.mkdtemp(prefix="spotidown-loadtest-"))
+    HISTORY_DB = ""
+    STATE_DB = ""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    
+    def phase(load: bool) -> dict:
+        stop = threading.Event()
+        counter = [0]
+        job = threading.Thread(target=_synthetic_job, args=(stop, counter), daemon=True)
+        results = multiprocessing.Queue()
+        client_proc = multiprocessing.Process(target=_loadtest_clients, args=(base_url, clients, duration, results))
+        cpu_before, wall_before = time.process_time(), time.monotonic()
+        job.start()
+        if load:
+            client_proc.start()
+        time.sleep(duration)
+        stop.set()
+        job.join()
+        wall = time.monotonic() - wall_before
+        report = {
+            "tracks_per_sec": round(counter[0] / wall, 2),
+            "server_cpu_pct": round((time.process_time() - cpu_before) / wall * 100, 1),
+        }
+        if load:
+            client_report = results.get()
+            client_proc.join()
+            report["errors"] = client_report["errors"]
+            report["latency"] = {k: _percentiles(v) for k, v in client_report["latencies"].items()}
+        return report
+    
+    print(f"Baseline: synthetic job alone for {duration:.0f}s...")
+    baseline = phase(False)
+    print(f"Load: {clients} dashboards polling every {LOADTEST_POLL_INTERVAL}s for {duration:.0f}s...")
+    loaded = phase(True)
+    server.shutdown()
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+    drop = 1 - loaded["tracks_per_sec"] / baseline["tracks_per_sec"] if baseline["tracks_per_sec"] else 0.0
+    return {"clients": clients, "duration": duration, "baseline": baseline, "loaded": loaded,
+            "throughput_drop_pct": round(drop * 100, 1)}
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spotify Playlist Downloader")
+    parser.add_argument("--worker", action="store_true", help="run as a download worker instead of the web UI")
+    parser.add_argument("--broker", default=BROKER_DB, help="path to the shared broker database")
+    parser.add_argument("--runner", action="store_true", help="run queued jobs from the shared state database")
+    parser.add_argument("--state", default=STATE_DB, help="path to the shared state database")
+    parser.add_argument("--watch", metavar="WATCH_JSON", help="watch the playlists in this file and sync changes")
+    parser.add_argument("--loadtest", type=int, metavar="CLIENTS", help="load-test the UI with this many dashboards")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per load-test phase")
+    parser.add_argument("--bench", metavar="URL", help="compare download engine throughput on this video URL")
+    parser.add_argument("--bench-runs", type=int, default=3, help="downloads per engine for --bench")
+    parser.add_argument("--history", default=HISTORY_DB, help="path to the job history database (\"\" disables)")
+    args = parser.parse_args()
+    clean_scratch()
+    BROKER_DB = args.broker
+    HISTORY_DB = args.history
+    
+    if args.bench:
+        print(json.dumps(run_bench(args.bench, args.bench_runs), indent=2))
+        raise SystemExit(0)
+    
+    if args.loadtest:
+        print(json.dumps(run_loadtest(args.loadtest, args.duration), indent=2))
+        raise SystemExit(0)
+    
+    if args.watch:
+        STATE_DB = args.state
+        run_watcher(args.watch)
+        raise SystemExit(0)
+    
+    if args.runner:
+        if not args.state:
+            parser.error("--runner needs --state or SPOTIDOWN_STATE")
+        run_job_runner(args.state)
+        raise SystemExit(0)
+    
+    if args.worker:
+        if not args.broker:
+            parser.error("--worker needs --broker or SPOTIDOWN_BROKER")
+        run_worker(args.broker)
+        raise SystemExit(0)
+    STATE_DB = args.state
+    
     print("""
     ╔═══════════════════════════════════════════════════════════╗
     ║                                                           ║
@@ -0,0 +1,86 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+import spotifyDown
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return spotifyDown.SQLiteBroker(str(tmp_path / "broker.db"))
+
+
+def expire_leases(broker):
+    with closing(sqlite3.connect(broker.path, isolation_level=None)) as db:
+        db.execute("UPDATE work_items SET lease_expires = 0 WHERE status = 'leased'")
+
+
+def attempts(broker, item_id):
+    with closing(sqlite3.connect(broker.path)) as db:
+        return db.execute("SELECT attempts FROM work_items WHERE id = ?", (item_id,)).fetchone()[0]
+
+
+def test_lease_hands_out_each_item_once(broker):
+    broker.enqueue("job", [{"n": 1}, {"n": 2}])
+    first = broker.lease("w1")
+    second = broker.lease("w2")
+    assert first[1] == {"n": 1}
+    assert second[1] == {"n": 2}
+    assert broker.lease("w3") is None
+
+
+def test_expired_lease_is_redelivered(broker):
+    broker.enqueue("job", [{"n": 1}])
+    item_id, _ = broker.lease("w1")
+    assert broker.lease("w2") is None
+    expire_leases(broker)
+    again = broker.lease("w2")
+    assert again == (item_id, {"n": 1})
+    assert attempts(broker, item_id) == 2
+
+
+def test_heartbeat_fails_after_redelivery(broker):
+    broker.enqueue("job", [{"n": 1}])
+    item_id, _ = broker.lease("w1")
+    assert broker.heartbeat(item_id, "w1")
+    expire_leases(broker)
+    broker.lease("w2")
+    assert not broker.heartbeat(item_id, "w1")
+    assert broker.heartbeat(item_id, "w2")
+
+
+def test_stale_worker_cannot_complete(broker):
+    broker.enqueue("job", [{"n": 1}])
+    item_id, _ = broker.lease("w1")
+    expire_leases(broker)
+    broker.lease("w2")
+    broker.complete(item_id, "w1", {"status": "completed", "note": "stale"})
+    assert broker.collect("job") == []
+    broker.complete(item_id, "w2", {"status": "completed", "note": "fresh"})
+    [(payload, result)] = broker.collect("job")
+    assert payload == {"n": 1}
+    assert result["note"] == "fresh"
+    assert broker.collect("job") == []
+
+
+def test_item_fails_after_max_attempts_on_lease(broker, monkeypatch):
+    monkeypatch.setattr(spotifyDown, "MAX_ATTEMPTS", 2)
+    broker.enqueue("job", [{"n": 1}])
+    for worker in ("w1", "w2"):
+        assert broker.lease(worker) is not None
+        expire_leases(broker)
+    assert broker.lease("w3") is None
+    [(_, result)] = broker.collect("job")
+    assert result["error_class"] == "worker_lost"
+
+
+def test_collect_expires_dead_items(broker, monkeypatch):
+    monkeypatch.setattr(spotifyDown, "MAX_ATTEMPTS", 1)
+    broker.enqueue("job", [{"n": 1}, {"n": 2}])
+    broker.lease("w1")
+    expire_leases(broker)
+    [(payload, result)] = broker.collect("job")
+    assert payload == {"n": 1}
+    assert result["status"] == "failed"
+    assert result["error_class"] == "worker_lost"